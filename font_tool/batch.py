@@ -0,0 +1,193 @@
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from font_generator import (
+    configure_download_cache, configure_http_client, expand_characters, font_coverage, generate_font_output,
+    generate_font_instances, get_font, iter_glyph_jobs, prefetch_google_fonts, resolve_font_instances,
+    resolve_workers
+)
+from download_cache import download_cache
+from instrumentation import configure_logging, instrumentation, profiled
+
+
+# Used for any key a batch manifest leaves out
+DEFAULT_JOB = {
+    'font_size': 64,
+    'image_size': 128,
+    'output_mode': 'images',
+    'incremental': True,
+    'characters': "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*()_+-=[]{}|;:,.<>?/\\ ",
+}
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _folder_safe(name):
+    return "".join(c if c.isalnum() else "_" for c in name)
+
+
+def expand_jobs(manifest):
+    """Expand a batch manifest into one config dict per font x image size x character set.
+
+    Every entry of manifest['jobs'] takes the same keys as config.json, except that
+    image_size may be a list and characters may be a {name: characters} dict
+    (each set being a string or a list of strings and Unicode ranges).
+    output_folder may use {font}, {image_size} and {charset} placeholders.
+    """
+    defaults = dict(DEFAULT_JOB, **manifest.get('defaults', {}))
+    jobs = []
+    for entry in manifest['jobs']:
+        entry = dict(defaults, **entry)
+        font_label = entry.get('font_name') or os.path.splitext(os.path.basename(entry['font_path']))[0]
+
+        character_sets = entry['characters']
+        if not isinstance(character_sets, dict):
+            character_sets = {'default': character_sets}
+
+        folder_template = entry.get('output_folder') or (
+            "{font}_{image_size}" if len(character_sets) == 1 else "{font}_{image_size}_{charset}"
+        )
+        for image_size, (charset, characters) in itertools.product(
+                _as_list(entry['image_size']), character_sets.items()):
+            job = dict(entry, image_size=int(image_size), characters=characters, charset=charset)
+            job['output_folder'] = folder_template.format(
+                font=_folder_safe(font_label), image_size=image_size, charset=_folder_safe(charset)
+            )
+            jobs.append(job)
+    return jobs
+
+
+def resolve_fonts(jobs, offline=False, workers=4):
+    """Download every distinct Google Font once and point its jobs at the cached file.
+
+    Distinct fonts are fetched concurrently over the shared HTTP session. Jobs
+    whose font cannot be fetched get a font_error instead of failing the batch.
+    """
+    def font_key(job):
+        subsets = job.get('font_subsets', 'latin')
+        return (job['font_name'], job.get('font_weight', 400), tuple(subsets) if isinstance(subsets, list) else subsets)
+
+    # Jobs with font_instances fetch their variable font themselves
+    google_jobs = [job for job in jobs if not job.get('font_path') and not job.get('font_instances')]
+    font_paths = prefetch_google_fonts([font_key(job) for job in google_jobs], workers, offline)
+    for job in google_jobs:
+        font_path = font_paths[font_key(job)]
+        if isinstance(font_path, Exception):
+            job['font_error'] = str(font_path)
+        else:
+            job['font_path'] = font_path
+    return jobs
+
+
+def count_glyphs(characters, font):
+    """Return the number of glyph images a character set gives with a font, leaving out what it cannot draw"""
+    return len(list(iter_glyph_jobs(expand_characters(characters), font_coverage(font))))
+
+
+def run_job(job):
+    """Render a single expanded job and return its timing report"""
+    start = time.perf_counter()
+    # Start from zero so the stage timings below belong to this job only
+    instrumentation.drain()
+    report = {
+        'font': job.get('font_name') or job['font_path'],
+        'image_size': job['image_size'],
+        'charset': job['charset'],
+        'output_folder': job['output_folder'],
+        'glyphs': 0,
+    }
+    try:
+        if job.get('font_error'):
+            raise Exception(f"Could not load font: {job['font_error']}")
+        # Fonts are loaded through the per-process font cache, so jobs sharing a font
+        # (and a worker) parse it once
+        mapping_path = job.get('mapping_path') or os.path.join(job['output_folder'], 'character_mapping.txt')
+        if job.get('font_instances'):
+            instances = resolve_font_instances(job)
+            for _, font_path, variation in instances:
+                report['glyphs'] += count_glyphs(job['characters'], get_font(font_path, job['font_size'], variation))
+            outputs = generate_font_instances(job, mapping_path, instances)
+            report['files'] = sum(len(paths) for paths in outputs.values())
+        else:
+            with download_cache.in_use(job['font_path']):
+                font = get_font(job['font_path'], job['font_size'])
+                report['glyphs'] = count_glyphs(job['characters'], font)
+                report['files'] = len(generate_font_output(job, font, mapping_path))
+    except Exception as e:
+        report['error'] = str(e)
+    report['seconds'] = round(time.perf_counter() - start, 4)
+    report.update(instrumentation.summary())
+    report['glyphs_per_sec'] = round(report['glyphs'] / report['seconds'], 1) if report['seconds'] else None
+    return report
+
+
+def run_batch(manifest, jobs_in_parallel=1, offline=False):
+    """Run every job of a batch manifest and return the overall report"""
+    start = time.perf_counter()
+    configure_download_cache(manifest.get('defaults', {}))
+    configure_http_client(manifest.get('defaults', {}))
+    jobs = resolve_fonts(expand_jobs(manifest), offline)
+    # font_instances jobs download their fonts themselves
+    jobs = [dict(job, offline=offline or job.get('offline', False)) for job in jobs]
+
+    jobs_in_parallel = min(resolve_workers(jobs_in_parallel), max(1, len(jobs)))
+    if jobs_in_parallel <= 1:
+        reports = [run_job(job) for job in jobs]
+    else:
+        # Jobs already run side by side, so each one renders its glyphs inline
+        jobs = [dict(job, workers=1) for job in jobs]
+        with ProcessPoolExecutor(max_workers=jobs_in_parallel) as pool:
+            reports = list(pool.map(run_job, jobs))
+
+    elapsed = time.perf_counter() - start
+    total_glyphs = sum(report['glyphs'] for report in reports if 'error' not in report)
+    return {
+        'jobs': reports,
+        'total_jobs': len(reports),
+        'failed_jobs': sum(1 for report in reports if 'error' in report),
+        'total_glyphs': total_glyphs,
+        'seconds': round(elapsed, 4),
+        'glyphs_per_sec': round(total_glyphs / elapsed, 1) if elapsed else None,
+    }
+
+
+def print_report(report):
+    for job in report['jobs']:
+        status = f"ERROR: {job['error']}" if 'error' in job else f"{job['glyphs_per_sec']} glyphs/s"
+        print(f"{job['output_folder']:<40} {job['glyphs']:>6} glyphs {job['seconds']:>9.3f}s  {status}")
+    print(f"\n{report['total_jobs']} jobs ({report['failed_jobs']} failed), {report['total_glyphs']} glyphs "
+          f"in {report['seconds']:.3f}s ({report['glyphs_per_sec']} glyphs/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render many fonts, sizes and character sets in one run")
+    parser.add_argument('manifest', help="batch manifest JSON file")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="jobs to run in parallel (0 = one per CPU core)")
+    parser.add_argument('--offline', action='store_true', help="only use fonts already in the download cache")
+    parser.add_argument('--report', help="also write the timing report as JSON to this file")
+    parser.add_argument('--log-level', default='WARNING', help="console log level (default: WARNING)")
+    parser.add_argument('--profile', help="run under cProfile and write the stats to this file")
+    args = parser.parse_args()
+
+    configure_logging(args.log_level)
+
+    with open(args.manifest, 'r') as f:
+        manifest = json.load(f)
+
+    with profiled(args.profile):
+        report = run_batch(manifest, args.jobs, args.offline)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['failed_jobs'] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,195 @@
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fontTools.ttLib import TTFont
+
+from font_generator import (
+    build_glyph_atlas, encode_png, font_cache, generate_character_mapping, generate_font_output,
+    get_font, glyph_advance, glyph_filename, iter_glyph_jobs, render_character_image
+)
+from instrumentation import instrumentation, logger
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+ASCII_CHARACTERS = "".join(chr(code) for code in range(0x20, 0x7f))
+DEFAULT_IMAGE_SIZES = [64, 128, 256, 512, 1024]
+DEFAULT_CHARSET_SIZES = [95, 500, 2000, 5000]
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in KiB, or None where unsupported"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KiB
+    return peak // 1024 if platform.system() == "Darwin" else peak
+
+
+def font_characters(font_path, count):
+    """Return up to count printable characters the font has glyphs for, ASCII first"""
+    cmap = TTFont(font_path, lazy=True).getBestCmap() or {}
+    codes = [code for code in range(0x20, 0x7f) if code in cmap]
+    codes += sorted(code for code in cmap if code >= 0xa0 and chr(code).isprintable())
+    return "".join(chr(code) for code in codes[:count])
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the generator's log output so it does not skew the timings"""
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+        yield
+    finally:
+        logger.setLevel(level)
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 1) if seconds else None
+
+
+def benchmark_case(font_path, font_size, image_size, characters):
+    """Time each pipeline stage for one image size and character set"""
+    glyph_jobs = list(iter_glyph_jobs(characters))
+    stages = {}
+
+    # Start cold, so font loading is part of what is measured
+    font_cache.clear()
+    with quiet(), tempfile.TemporaryDirectory() as work_dir:
+        start = time.perf_counter()
+        font = get_font(font_path, font_size)
+        stages['load'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        images = [render_character_image(char, font, image_size) for char, _ in glyph_jobs]
+        stages['rasterize'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        encoded = [encode_png(image) for image in images]
+        stages['encode'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for (char, case_prefix), data in zip(glyph_jobs, encoded):
+            with open(os.path.join(work_dir, f"{glyph_filename(char, case_prefix)}.png"), 'wb') as f:
+                f.write(data)
+        stages['write'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        glyphs = [(char, glyph_filename(char, case_prefix), image, glyph_advance(char, font, image_size))
+                  for (char, case_prefix), image in zip(glyph_jobs, images)]
+        build_glyph_atlas(glyphs)
+        stages['atlas'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        generate_character_mapping(characters, 'output', os.path.join(work_dir, 'character_mapping.txt'))
+        stages['mapping'] = time.perf_counter() - start
+
+        # End to end through the same entry point as the CLI, cold and non-incremental
+        font_cache.clear()
+        config = {
+            'characters': characters,
+            'font_size': font_size,
+            'image_size': image_size,
+            'output_folder': os.path.join(work_dir, 'end_to_end'),
+            'incremental': False,
+        }
+        instrumentation.reset()
+        start = time.perf_counter()
+        generate_font_output(config, get_font(font_path, font_size), os.path.join(work_dir, 'mapping.txt'))
+        end_to_end = time.perf_counter() - start
+        end_to_end_summary = instrumentation.summary()
+
+    return {
+        'image_size': image_size,
+        'characters': len(characters),
+        'glyphs': len(glyph_jobs),
+        'stages': {name: round(seconds, 5) for name, seconds in stages.items()},
+        'glyphs_per_sec': {name: _rate(len(glyph_jobs), seconds) for name, seconds in stages.items()
+                           if name in ('rasterize', 'encode', 'write', 'atlas')},
+        'end_to_end_seconds': round(end_to_end, 5),
+        'end_to_end_glyphs_per_sec': _rate(len(glyph_jobs), end_to_end),
+        'end_to_end_stages': end_to_end_summary['stages'],
+        'end_to_end_counters': end_to_end_summary['counters'],
+    }
+
+
+def _isolated_case(font_path, font_size, image_size, characters):
+    # Runs in a fresh process, so the peak RSS belongs to this case alone
+    case = benchmark_case(font_path, font_size, image_size, characters)
+    case['peak_rss_kb'] = peak_rss_kb()
+    return case
+
+
+def run_isolated_case(font_path, font_size, image_size, characters):
+    """Run benchmark_case in a newly spawned process and add that process's peak RSS to the result"""
+    # Spawned rather than forked: a forked child would start with this process's peak
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_isolated_case, font_path, font_size, image_size, characters).result()
+
+
+def run_benchmark(font_path, font_size=64, image_sizes=None, charset_sizes=None):
+    """Run every image size x character set size case and return the machine-readable report"""
+    image_sizes = image_sizes or DEFAULT_IMAGE_SIZES
+    charset_sizes = charset_sizes or DEFAULT_CHARSET_SIZES
+    cases = []
+    for charset_size in charset_sizes:
+        if charset_size == len(ASCII_CHARACTERS):
+            characters = ASCII_CHARACTERS
+        else:
+            characters = font_characters(font_path, charset_size)
+        for image_size in image_sizes:
+            case = run_isolated_case(font_path, font_size, image_size, characters)
+            case['requested_characters'] = charset_size
+            cases.append(case)
+            print(f"{image_size:>5}px {case['glyphs']:>6} glyphs  end to end {case['end_to_end_seconds']:>9.3f}s "
+                  f"({case['end_to_end_glyphs_per_sec']} glyphs/s)", file=sys.stderr)
+    return {
+        'font': os.path.basename(font_path),
+        'font_size': font_size,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cases': cases,
+    }
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the font generation pipeline on a local font file")
+    default_font = os.environ.get('VERSE_FONT_BENCH_FONT')
+    parser.add_argument('--font', default=default_font, required=not default_font,
+                        help="local .ttf/.otf to benchmark with (or set VERSE_FONT_BENCH_FONT)")
+    parser.add_argument('--font-size', type=int, default=64)
+    parser.add_argument('--image-sizes', type=_int_list, default=DEFAULT_IMAGE_SIZES,
+                        help="comma separated image sizes (default: 64,128,256,512,1024)")
+    parser.add_argument('--charset-sizes', type=_int_list, default=DEFAULT_CHARSET_SIZES,
+                        help="comma separated character set sizes, capped at what the font covers (default: 95,500,2000,5000)")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.font, args.font_size, args.image_sizes, args.charset_sizes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
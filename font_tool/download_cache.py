@@ -0,0 +1,225 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# Where downloaded fonts are kept between runs
+DEFAULT_CACHE_DIR = os.environ.get(
+    'VERSE_FONT_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'verse_font_tool')
+)
+
+
+class FontDownloadCache:
+    """Persistent on-disk cache of converted Google Fonts (family + weight + subset -> TTF).
+
+    TTF files are stored content-addressed under blobs/ by their SHA-256, so the
+    same file downloaded for two requests is only kept once. index.json records,
+    for every request key, which blob it resolved to plus the ETag/Last-Modified
+    validators of the CSS response so stale entries can be revalidated cheaply.
+    Least recently used entries are evicted once the cache grows past max_bytes,
+    except for fonts a job is rendering with (see in_use). Every change re-reads
+    the index under a lock file, so processes sharing the cache keep each
+    other's entries.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=512 * 1024 * 1024, max_age=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Number of running jobs of this process using each blob digest
+        self._in_use = {}
+        self._lock = threading.RLock()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, 'index.json')
+
+    @property
+    def blob_dir(self):
+        return os.path.join(self.cache_dir, 'blobs')
+
+    @staticmethod
+    def key(family, weight, subset):
+        # Several subsets merged into one font are cached under all their names
+        if isinstance(subset, (list, tuple)):
+            subset = "+".join(subset)
+        return f"{family.strip().lower()}|{weight}|{subset}"
+
+    def _load(self):
+        # Always read from disk, other processes may have changed the index
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, index):
+        # Write atomically so a crash never leaves a truncated index behind
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(temp_path, self.index_path)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """Hold the cache lock, across processes where supported, and yield the index as it is on disk"""
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.cache_dir, 'index.lock'), 'a') as lock_file:
+                # Released when the file is closed
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield self._load()
+
+    @contextlib.contextmanager
+    def in_use(self, path):
+        """Keep a cached font from being evicted while the enclosed block renders with it.
+
+        Fonts are reopened by path (e.g. at other sizes), so a blob must stay on
+        disk until the job is done. Paths outside the cache are ignored.
+        """
+        digest = None
+        if isinstance(path, str) and os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.blob_dir):
+            digest = os.path.splitext(os.path.basename(path))[0]
+        if digest is None:
+            yield path
+            return
+        with self._lock:
+            self._in_use[digest] = self._in_use.get(digest, 0) + 1
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._in_use[digest] -= 1
+                if not self._in_use[digest]:
+                    del self._in_use[digest]
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, f"{digest}.ttf")
+
+    def lookup(self, family, weight, subset):
+        """Return the cache entry for a request, or None if missing or its file is gone"""
+        with self._lock:
+            entry = self._load().get(self.key(family, weight, subset))
+            if entry is None:
+                return None
+            entry = dict(entry, path=self._blob_path(entry['digest']))
+            if not os.path.exists(entry['path']):
+                return None
+            return entry
+
+    def is_fresh(self, entry):
+        """True if an entry was (re)validated recently enough to be used without any network I/O"""
+        return time.time() - entry.get('validated', 0) < self.max_age
+
+    @staticmethod
+    def validators(entry):
+        """Return conditional request headers for revalidating an entry's CSS"""
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def touch(self, family, weight, subset, revalidated=False, etag=None, last_modified=None):
+        """Mark an entry as used (and optionally as freshly revalidated)"""
+        with self._locked_index() as index:
+            entry = index.get(self.key(family, weight, subset))
+            if entry is None:
+                return
+            now = time.time()
+            entry['last_used'] = now
+            if revalidated:
+                entry['validated'] = now
+                entry['etag'] = etag or entry.get('etag')
+                entry['last_modified'] = last_modified or entry.get('last_modified')
+            self._save(index)
+
+    def store(self, family, weight, subset, ttf_data, font_url=None, etag=None, last_modified=None):
+        """Write the bytes of a converted TTF into the cache and return its cached path"""
+        digest = hashlib.sha256(ttf_data).hexdigest()
+
+        with self._locked_index() as index:
+            os.makedirs(self.blob_dir, exist_ok=True)
+            blob_path = self._blob_path(digest)
+            if not os.path.exists(blob_path):
+                # Write next to the blob and rename, so a crash never leaves half a font behind
+                fd, temp_path = tempfile.mkstemp(dir=self.blob_dir, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(ttf_data)
+                os.replace(temp_path, blob_path)
+
+            now = time.time()
+            key = self.key(family, weight, subset)
+            index[key] = {
+                'family': family,
+                'weight': weight,
+                'subset': subset,
+                'digest': digest,
+                'size': os.path.getsize(blob_path),
+                'font_url': font_url,
+                'etag': etag,
+                'last_modified': last_modified,
+                'validated': now,
+                'last_used': now,
+            }
+            self._evict(index, keep=key)
+            self._save(index)
+            return blob_path
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        with self._locked_index() as index:
+            self._evict(index)
+            self._save(index)
+
+    def _evict(self, index, keep=None):
+        # Blobs can be shared between entries, so count each one once
+        blob_sizes = {entry['digest']: entry['size'] for entry in index.values()}
+        total = sum(blob_sizes.values())
+        for key in sorted(index, key=lambda k: index[k].get('last_used', 0)):
+            if total <= self.max_bytes or len(index) <= 1:
+                break
+            # Running jobs may still reopen these fonts by path, and a new entry is about to be used
+            if key == keep or index[key]['digest'] in self._in_use:
+                continue
+            digest = index.pop(key)['digest']
+            if all(entry['digest'] != digest for entry in index.values()):
+                total -= blob_sizes[digest]
+
+        # Remove blobs no entry points at, including ones orphaned by older versions
+        # and temporary files of interrupted writes
+        referenced = {entry['digest'] for entry in index.values()}
+        try:
+            names = os.listdir(self.blob_dir)
+        except OSError:
+            names = []
+        for name in names:
+            digest, extension = os.path.splitext(name)
+            if extension == '.ttf' and (digest in referenced or digest in self._in_use):
+                continue
+            try:
+                os.unlink(os.path.join(self.blob_dir, name))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._locked_index():
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+# Shared by download_google_font and validate_font_name
+download_cache = FontDownloadCache()
@@ -1,8 +1,20 @@
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, PngImagePlugin
+from collections import OrderedDict
+import contextlib
 import os
+import io
+import math
+import multiprocessing
+import re
 import json
-import requests
-import tempfile
+import hashlib
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from download_cache import download_cache
+from http_client import http_client
+from instrumentation import instrumentation, logger, configure_logging, profiled
 
 
 # Character name mapping for special characters
@@ -42,157 +54,532 @@ char_name_map = {
     ' ': 'space'
 }
 
+class FontCache:
+    """LRU cache of loaded ImageFont instances keyed on (font path, size, variation).
+
+    The path may also be an in-memory file such as a BytesIO of TTF data, which
+    is keyed on the buffer object itself. Hits and misses are counted in the
+    instrumentation as font_cache_hits and font_cache_misses.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._fonts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _variation_key(variation):
+        # Named instances are strings, axis values come in as any sequence
+        if variation is None or isinstance(variation, str):
+            return variation
+        return tuple(variation)
+
+    def get(self, path, size, variation=None):
+        """Return a font for path/size/variation, loading it on first use"""
+        key = (path, int(size), self._variation_key(variation))
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                instrumentation.count('font_cache_hits')
+                return font
+        instrumentation.count('font_cache_misses')
+
+        with instrumentation.stage('load'):
+            # Fonts loaded from a buffer are read in full each time, so start from the top
+            if hasattr(path, 'seek'):
+                path.seek(0)
+            font = ImageFont.truetype(path, int(size))
+        if isinstance(variation, str):
+            font.set_variation_by_name(variation)
+        elif variation is not None:
+            font.set_variation_by_axes(list(variation))
+        # Rescaled copies of the font (see rescaled_font) keep the same instance
+        font.variation = key[2]
+
+        with self._lock:
+            self._fonts[key] = font
+            self._fonts.move_to_end(key)
+            while len(self._fonts) > self.maxsize:
+                self._fonts.popitem(last=False)
+        return font
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+
+
+# Shared by the CLI, the Gradio app and create_character_image
+font_cache = FontCache()
+
+
+def get_font(path, size, variation=None):
+    """Load a font through the shared font cache"""
+    return font_cache.get(path, size, variation)
+
+
+def rescaled_font(font, size):
+    """Return the same font file and variable font instance at another size"""
+    return get_font(font.path, size, getattr(font, 'variation', None))
+
+
 def load_config():
     with open('config.json', 'r') as f:
         return json.load(f)
 
 
-def download_google_font(font_family):
-    """Download a font from Google Fonts API"""
+def configure_download_cache(config):
+    """Apply the font_cache_dir / font_cache_max_mb config options to the download cache"""
+    if config.get('font_cache_dir'):
+        download_cache.cache_dir = config['font_cache_dir']
+    if config.get('font_cache_max_mb'):
+        download_cache.max_bytes = int(config['font_cache_max_mb'] * 1024 * 1024)
+
+
+def configure_http_client(config):
+    """Apply the http_timeout / http_retries config options to the shared HTTP session"""
+    http_client.configure(config.get('http_timeout'), config.get('http_retries'))
+
+
+# Google Fonts CSS endpoint, overridable so a local HTTP stand-in can serve it
+GOOGLE_FONTS_CSS_URL = os.environ.get('GOOGLE_FONTS_CSS_URL', 'https://fonts.googleapis.com/css2')
+
+
+# Sent with every Google Fonts request; the user agent decides that the CSS serves WOFF2 files
+GOOGLE_FONTS_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/css,*/*;q=0.1',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Referer': 'https://fonts.googleapis.com/',
+}
+
+# Seconds a fetched CSS response is reused, so validating a font and then downloading it asks the API once
+CSS_RESPONSE_TTL = 300
+_css_responses = {}
+_css_lock = threading.Lock()
+
+
+def font_axes_spec(weight):
+    """Return the css2 axis list for a weight, or for {axis tag: value or [min, max]}.
+
+    Ranges ask Google Fonts for the variable font, e.g. {'wght': [300, 700],
+    'ital': 1} gives 'ital,wght@1,300..700'. The result is also what the
+    download cache keys the font on.
+    """
+    if not isinstance(weight, dict):
+        # Plain weights and specs that were already built pass through
+        return weight if isinstance(weight, str) and '@' in weight else f"wght@{weight}"
+    # Google Fonts wants lowercase (registered) axes first, each group alphabetically
+    tags = sorted(weight, key=lambda tag: (tag.isupper(), tag))
+    values = [f"{value[0]}..{value[1]}" if isinstance(value, (list, tuple)) else f"{value}"
+              for value in (weight[tag] for tag in tags)]
+    return f"{','.join(tags)}@{','.join(values)}"
+
+
+def google_fonts_css_url(font_family, weight=400):
+    """Return the Google Fonts CSS URL of a family and weight (or axes, see font_axes_spec)"""
     # Format font family name for URL (replace spaces with plus signs)
-    formatted_font_name = font_family.replace(' ', '+')
-    
-    # Get the font information from Google Fonts API
-    api_url = f"https://fonts.googleapis.com/css2?family={formatted_font_name}:wght@400&display=swap"
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept': 'text/css,*/*;q=0.1',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Referer': 'https://fonts.googleapis.com/',
-    }
-    
-    print(f"\nRequesting font: {font_family}")
-    print(f"URL: {api_url}")
-    
-    response = requests.get(api_url, headers=headers)
+    return f"{GOOGLE_FONTS_CSS_URL}?family={font_family.replace(' ', '+')}:{font_axes_spec(weight)}&display=swap"
+
+
+def fetch_font_css(font_family, weight=400, validators=None):
+    """GET the Google Fonts CSS of a family, reusing a successful response from the last CSS_RESPONSE_TTL seconds.
+
+    validators are conditional request headers (ETag / Last-Modified) for a
+    cached font, and only apply when a new request is made.
+    """
+    api_url = google_fonts_css_url(font_family, weight)
+    with _css_lock:
+        fetched = _css_responses.get(api_url)
+    if fetched and time.monotonic() - fetched[0] < CSS_RESPONSE_TTL:
+        logger.debug("Reusing CSS response for %s", api_url)
+        return fetched[1]
+
+    logger.debug("URL: %s", api_url)
+    response = http_client.get(api_url, headers=dict(GOOGLE_FONTS_HEADERS, **(validators or {})))
+    if response.status_code == 200:
+        now = time.monotonic()
+        with _css_lock:
+            # Drop expired responses, so a long-running server does not keep one per font forever
+            for url in [url for url, (fetched_at, _) in _css_responses.items() if now - fetched_at >= CSS_RESPONSE_TTL]:
+                del _css_responses[url]
+            _css_responses[api_url] = (now, response)
+    return response
+
+
+def parse_font_faces(css_content):
+    """Return {subset: woff2 URL} for the @font-face rules of a Google Fonts CSS response, in CSS order"""
+    font_faces = {}
+    for match in re.finditer(r"(?:/\*\s*([\w-]+)\s*\*/\s*)?@font-face\s*\{([^}]*)\}", css_content):
+        url = re.search(r"url\(\s*['\"]?([^'\")]+\.woff2)['\"]?\s*\)", match.group(2))
+        if url:
+            font_faces.setdefault(match.group(1) or f"face{len(font_faces)}", url.group(1))
+    return font_faces
+
+
+def woff2_to_ttf(woff2_files):
+    """Decompress WOFF2 font data to TTF bytes, merging several subsets into one font"""
+    from fontTools.ttLib import TTFont
+
+    buffers = []
+    for woff2_data in woff2_files:
+        font = TTFont(io.BytesIO(woff2_data))
+        font.flavor = None
+        buffer = io.BytesIO()
+        font.save(buffer)
+        buffers.append(buffer)
+
+    # Subsets are separate fonts, so combine them into one
+    if len(buffers) > 1:
+        from fontTools.merge import Merger
+        buffer = io.BytesIO()
+        Merger().merge(buffers).save(buffer)
+        return buffer.getvalue()
+    return buffers[0].getvalue()
+
+
+def save_font_test_image(ttf_data, path, test_char="A", test_size=128):
+    """Render a test character of in-memory TTF data to an image for inspection"""
+    test_font = ImageFont.truetype(io.BytesIO(ttf_data), 64)
+    logger.debug("Font family: %s, size: %s", test_font.getname(), test_font.size)
+    logger.debug("Bounding box for '%s': %s", test_char, test_font.getbbox(test_char))
+
+    test_img = Image.new('RGB', (test_size, test_size), color='black')
+    test_draw = ImageDraw.Draw(test_img)
+
+    # Center the test character
+    test_bbox = test_draw.textbbox((0, 0), test_char, font=test_font)
+    test_width = test_bbox[2] - test_bbox[0]
+    test_height = test_bbox[3] - test_bbox[1]
+    test_x = (test_size - test_width) // 2
+    test_y = (test_size - test_height) // 2
+
+    test_draw.text((test_x, test_y), test_char, font=test_font, fill='white')
+    logger.debug("Test character dimensions: %dx%d at (%d, %d)", test_width, test_height, test_x, test_y)
+    test_img.save(path)
+    logger.debug("Saved test image as '%s'", path)
+
+
+def download_google_font(font_family, weight=400, subset='latin', offline=False, cache=None, test_image=None):
+    """Download a font from Google Fonts API, going through the on-disk download cache.
+
+    Cached fonts are returned without any network I/O until they are older than
+    the cache's max_age, after which the CSS is revalidated with a conditional
+    request. In offline mode only the cache is consulted. subset may also be a
+    list of subsets (e.g. ['latin', 'cyrillic']), which are merged into one TTF.
+    The font is converted in memory; test_image is an optional path to render a
+    test character of a newly downloaded font to. weight may also be a dict of
+    axes and ranges (see font_axes_spec) to download a variable font.
+    """
+    cache = cache or download_cache
+    if isinstance(weight, dict):
+        weight = font_axes_spec(weight)
+    cached = cache.lookup(font_family, weight, subset)
+    if cached and (offline or cache.is_fresh(cached)):
+        cache.touch(font_family, weight, subset)
+        logger.info("Using cached font: %s (%s)", font_family, cached['path'])
+        instrumentation.count('download_cache_hits')
+        return cached['path']
+    if offline:
+        raise Exception(f"Font '{font_family}' is not in the font cache and offline mode is enabled")
+
+    logger.info("Requesting font: %s", font_family)
+    response = fetch_font_css(font_family, weight, cache.validators(cached) if cached else None)
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if cached and response.status_code == 304:
+        cache.touch(font_family, weight, subset, revalidated=True, etag=etag, last_modified=last_modified)
+        logger.info("Cached font is still current")
+        return cached['path']
     if response.status_code != 200:
         raise Exception(f"Failed to fetch font information: {response.status_code}")
     
     # Extract the font URL from the CSS
     css_content = response.text
-    print("\nCSS Response:")
-    print(css_content)
+    logger.debug("CSS Response:\n%s", css_content)
     
-    # First try to find the basic latin version
-    font_url = None
-    for line in css_content.split('\n'):
-        if '.woff2' in line and 'url' in line and '/* latin */' in css_content[:css_content.find(line)]:
-            start = line.find('url(') + 4
-            end = line.find(')', start)
-            font_url = line[start:end]
-            if font_url.startswith("'") or font_url.startswith('"'):
-                font_url = font_url[1:-1]
-            break
+    # Pick the requested subsets (basic latin by default)
+    font_faces = parse_font_faces(css_content)
+    subsets = [subset] if isinstance(subset, str) else list(subset)
+    font_urls = [font_faces[name] for name in subsets if name in font_faces]
+    missing = [name for name in subsets if name not in font_faces]
+    if missing and font_urls:
+        logger.warning("Subsets not available for %s: %s", font_family, ", ".join(missing))
     
-    # If no latin version found, use the first available font URL
-    if not font_url:
-        for line in css_content.split('\n'):
-            if '.woff2' in line and 'url' in line:
-                start = line.find('url(') + 4
-                end = line.find(')', start)
-                font_url = line[start:end]
-                if font_url.startswith("'") or font_url.startswith('"'):
-                    font_url = font_url[1:-1]
-                break
+    # If no subset is found, use the first available font URL
+    if not font_urls and font_faces:
+        font_urls = [next(iter(font_faces.values()))]
     
-    if not font_url:
+    if not font_urls:
         raise Exception("Could not find font URL in CSS")
     
-    print(f"\nFont URL: {font_url}")
-    
-    # Download the font file
-    font_response = requests.get(font_url, headers=headers)
-    if font_response.status_code != 200:
-        raise Exception(f"Failed to download font: {font_response.status_code}")
-    
-    # Save to a temporary file
-    temp_font_file = tempfile.NamedTemporaryFile(delete=False, suffix='.woff2')
-    temp_font_file.write(font_response.content)
-    temp_font_file.close()
-    
-    print(f"\nDownloaded WOFF2 file size: {os.path.getsize(temp_font_file.name)} bytes")
-    
-    # Convert WOFF2 to TTF using fontTools
-    from fontTools.ttLib import TTFont
+    font_url = " ".join(font_urls)
+    logger.debug("Font URL: %s", font_url)
+
+    # The CSS changed but still points at the same file, so the cached TTF is current
+    if cached and cached.get('font_url') == font_url:
+        cache.touch(font_family, weight, subset, revalidated=True, etag=etag, last_modified=last_modified)
+        return cached['path']
     
-    try:
-        # Load the WOFF2 font
-        font = TTFont(temp_font_file.name)
-        
-        # Save as TTF
-        ttf_path = temp_font_file.name[:-6] + '.ttf'  # Remove .woff2 and add .ttf
-        font.save(ttf_path)
-        
-        print(f"Converted to TTF: {ttf_path}")
-        print(f"TTF file size: {os.path.getsize(ttf_path)} bytes")
-        
-        # Test the font
-        test_font = ImageFont.truetype(ttf_path, 64)
-        # Get font info
-        print("\nFont information:")
-        print(f"Font family: {test_font.getname()}")
-        print(f"Font size: {test_font.size}")
-        
-        # Test metrics
-        test_char = "A"
-        bbox = test_font.getbbox(test_char)
-        print(f"\nBounding box for '{test_char}': {bbox}")
-        
-        # Create test image
-        test_size = 128
-        test_img = Image.new('RGB', (test_size, test_size), color='black')
-        test_draw = ImageDraw.Draw(test_img)
-        
-        # Get test character dimensions
-        test_bbox = test_draw.textbbox((0, 0), test_char, font=test_font)
-        test_width = test_bbox[2] - test_bbox[0]
-        test_height = test_bbox[3] - test_bbox[1]
-        
-        # Center the test character
-        test_x = (test_size - test_width) // 2
-        test_y = (test_size - test_height) // 2
-        
-        # Draw test character
-        test_draw.text((test_x, test_y), test_char, font=test_font, fill='white')
-        print(f"Test character dimensions: {test_width}x{test_height}")
-        print(f"Test character position: ({test_x}, {test_y})")
-        
-        # Save test image for inspection
-        test_img.save('font_test.png')
-        print("Saved test image as 'font_test.png'")
-        
-    except Exception as e:
-        print(f"\nError during font processing: {str(e)}")
-        raise e
-    finally:
-        # Clean up the WOFF2 file
+    # Download the font files, several subsets at once over the pooled session
+    with ThreadPoolExecutor(max_workers=len(font_urls)) as executor:
+        font_responses = list(executor.map(lambda url: http_client.get(url, headers=GOOGLE_FONTS_HEADERS), font_urls))
+    for font_response in font_responses:
+        if font_response.status_code != 200:
+            raise Exception(f"Failed to download font: {font_response.status_code}")
+        logger.debug("Downloaded WOFF2 file size: %d bytes", len(font_response.content))
+
+    # Convert WOFF2 to TTF in memory, no temporary files involved
+    with instrumentation.stage('convert'):
+        ttf_data = woff2_to_ttf([font_response.content for font_response in font_responses])
+    logger.debug("Converted to TTF: %d bytes", len(ttf_data))
+
+    if test_image:
+        save_font_test_image(ttf_data, test_image)
+
+    # Keep the converted TTF in the download cache for the next run
+    return cache.store(font_family, weight, subset, ttf_data, font_url, etag, last_modified)
+
+
+def prefetch_google_fonts(fonts, workers=4, offline=False):
+    """Download several (font_family, weight, subset) fonts concurrently.
+
+    Returns {(font_family, weight, subset): TTF path or the exception raised},
+    so one failing family does not stop the others.
+    """
+    fonts = list(dict.fromkeys((family, weight, tuple(subset) if isinstance(subset, list) else subset)
+                               for family, weight, subset in fonts))
+
+    def fetch(font):
+        family, weight, subset = font
         try:
-            os.unlink(temp_font_file.name)
-        except:
-            pass
-    
-    return ttf_path
+            return download_google_font(family, weight, list(subset) if isinstance(subset, tuple) else subset, offline=offline)
+        except Exception as e:
+            return e
 
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(fonts)))) as executor:
+        return dict(zip(fonts, executor.map(fetch, fonts)))
 
-def create_character_image(char, font, image_size, output_folder, case_prefix=''):
-    # Special case for space character
+
+def font_instance_axes(instance):
+    """Return the axis values ({tag: value}) of a font_instances entry"""
+    return {tag: value for tag, value in instance.items() if tag != 'name'}
+
+
+def font_instance_name(instance):
+    """Return the name an instance's outputs are namespaced with, e.g. 'bold' or 'wght700_wdth75'"""
+    name = instance.get('name') or "_".join(f"{tag}{value}" for tag, value in sorted(font_instance_axes(instance).items()))
+    # The name ends up in folder names and Verse module paths
+    return re.sub(r"\W", "_", name) or "default"
+
+
+def variation_axis_values(font_path, axes):
+    """Return axes ({tag: value}) as the value list set_variation_by_axes takes, or None for a static font.
+
+    Axes the font does not vary along are ignored (ital usually selects a
+    separate font file); the others default to the font's default instance
+    and are clamped to the font's range.
+    """
+    from fontTools.ttLib import TTFont
+
+    with TTFont(font_path, lazy=True) as ttfont:
+        if 'fvar' not in ttfont:
+            return None
+        values = []
+        for axis in ttfont['fvar'].axes:
+            value = axes.get(axis.axisTag, axis.defaultValue)
+            clamped = min(max(value, axis.minValue), axis.maxValue)
+            if clamped != value:
+                logger.warning("%s %s is outside the font's %s..%s range, using %s",
+                               axis.axisTag, value, axis.minValue, axis.maxValue, clamped)
+            values.append(clamped)
+        return values
+
+
+# Default values of the registered axes, which instances leaving an axis out render at
+REGISTERED_AXIS_DEFAULTS = {'wght': 400, 'wdth': 100, 'slnt': 0}
+
+
+def resolve_font_instances(config):
+    """Return [(instance name, font path, variation)] for the config's font_instances.
+
+    A local font_path serves every instance. Otherwise the Google Font is
+    downloaded once per italic setting as a variable font covering the range
+    of every requested axis; families without a variable font fall back to a
+    static download per instance. variation is None for static fonts.
+    """
+    instances = config['font_instances']
+    names = [font_instance_name(instance) for instance in instances]
+    if len(set(names)) != len(names):
+        raise Exception(f"Font instance names must be unique: {names}")
+
+    def download(weight):
+        return download_google_font(config['font_name'], weight or 400, config.get('font_subsets', 'latin'),
+                                    offline=config.get('offline', False))
+
+    if config.get('font_path'):
+        font_paths = {name: config['font_path'] for name in names}
+    else:
+        font_paths = {}
+        groups = {}
+        for name, instance in zip(names, instances):
+            groups.setdefault(bool(instance.get('ital')), []).append((name, font_instance_axes(instance)))
+        for italic, group in groups.items():
+            ranges = {}
+            for _, axes in group:
+                for tag, value in axes.items():
+                    if tag != 'ital':
+                        ranges.setdefault(tag, []).append(value)
+            # Instances leaving an axis out use its default, so the downloaded range must include it
+            for tag, values in ranges.items():
+                if len(values) < len(group):
+                    if tag in REGISTERED_AXIS_DEFAULTS:
+                        values.append(REGISTERED_AXIS_DEFAULTS[tag])
+                    else:
+                        logger.warning("Some font_instances leave out %s, they render at the nearest of %s..%s",
+                                       tag, min(values), max(values))
+            request = {tag: [min(values), max(values)] if min(values) != max(values) else values[0]
+                       for tag, values in ranges.items()}
+            if italic:
+                request['ital'] = 1
+            try:
+                font_path = download(request)
+                font_paths.update((name, font_path) for name, _ in group)
+            except Exception as e:
+                if not any(isinstance(value, list) for value in request.values()):
+                    raise
+                logger.info("No variable font for %s (%s), downloading every instance", config['font_name'], e)
+                for name, axes in group:
+                    font_paths[name] = download(axes)
+
+    resolved = []
+    for name, instance in zip(names, instances):
+        variation = variation_axis_values(font_paths[name], font_instance_axes(instance))
+        if variation is None and len(set(font_paths.values())) < len(names):
+            logger.warning("%s is not a variable font, so instance %s renders its only face",
+                           font_paths[name], name)
+        resolved.append((name, font_paths[name], variation))
+    return resolved
+
+
+UNICODE_RANGE_PATTERN = re.compile(r"^U\+([0-9A-Fa-f]{1,6})(?:-(?:U\+)?([0-9A-Fa-f]{1,6}))?$")
+
+
+def expand_characters(spec):
+    """Turn a characters config value into a string of unique characters.
+
+    spec is either a literal string, or a list whose items are literal strings
+    or Unicode ranges like "U+0400-04FF" / "U+20AC". Ranges only contribute
+    printable characters.
+    """
+    if isinstance(spec, str):
+        return spec
+    characters = []
+    for item in spec:
+        match = UNICODE_RANGE_PATTERN.match(item.strip())
+        if match:
+            first = int(match.group(1), 16)
+            last = int(match.group(2) or match.group(1), 16)
+            characters.extend(chr(code) for code in range(first, last + 1) if chr(code).isprintable())
+        else:
+            characters.append(item)
+    return "".join(dict.fromkeys("".join(characters)))
+
+
+# Code point sets of the most recently used font files, keyed on their digest
+FONT_COVERAGE_CACHE_SIZE = 32
+_font_coverage = OrderedDict()
+_font_coverage_lock = threading.Lock()
+
+
+def font_coverage(font):
+    """Return the set of code points a loaded font has glyphs for, or None when it cannot be read"""
+    font_path = getattr(font, 'path', None)
+    if not isinstance(font_path, str):
+        return None
+    digest = font_file_digest(font_path)
+    with _font_coverage_lock:
+        coverage = _font_coverage.get(digest)
+        if coverage is not None:
+            _font_coverage.move_to_end(digest)
+            return coverage
+
+    from fontTools.ttLib import TTFont
+    with TTFont(font_path, lazy=True) as ttfont:
+        coverage = frozenset(ttfont.getBestCmap() or {})
+    with _font_coverage_lock:
+        _font_coverage[digest] = coverage
+        while len(_font_coverage) > FONT_COVERAGE_CACHE_SIZE:
+            _font_coverage.popitem(last=False)
+    return coverage
+
+
+def covered_characters(characters, font):
+    """Drop the characters the font has no glyph for, so they are never rasterized as tofu"""
+    coverage = font_coverage(font)
+    if coverage is None:
+        return characters
+    covered = "".join(char for char in characters if char == ' ' or ord(char) in coverage)
+    missing = len(characters) - len(covered)
+    if missing:
+        logger.warning("Skipping %d characters the font has no glyphs for", missing)
+    # The other case of a covered letter may still be missing; iter_glyph_jobs leaves those out
+    missing_cases = len(list(iter_glyph_jobs(covered))) - len(list(iter_glyph_jobs(covered, coverage)))
+    if missing_cases:
+        logger.warning("Skipping %d case variants the font has no glyphs for", missing_cases)
+    if missing or missing_cases:
+        instrumentation.count('characters_missing', missing + missing_cases)
+    return covered
+
+
+def glyph_char_name(char):
+    """Return the name of a character in image and asset names"""
+    if char in char_name_map:
+        return char_name_map[char]
+    if char.isascii() and char.isalnum():
+        return char
+    # Anything else would not survive as a file or Verse asset name, so use the code point
+    return f"u{ord(char):04X}"
+
+
+def glyph_filename(char, case_prefix=''):
+    """Return the image file name (without extension) used for a character"""
     if char == ' ':
-        actual_width = image_size
-        image = Image.new('RGBA', (actual_width, image_size), (0, 0, 0, 0))
-        filename = f"custom_font_S_space"
-        image.save(os.path.join(output_folder, f"{filename}.png"))
-        return
+        return "custom_font_S_space"
+    filename = f"custom_font_{case_prefix}{glyph_char_name(char)}"
+    return "".join(c if c.isalnum() else "_" for c in filename)
 
-    print(f"\nGenerating image for character: '{char}'")
-    
-    # Get font metrics for proper sizing
-    ascent, descent = font.getmetrics()
-    total_height = ascent + abs(descent)
-    
-    # Create a temporary image for measurements
-    temp_image = Image.new('RGBA', (image_size * 2, image_size * 2), (0, 0, 0, 0))
-    temp_draw = ImageDraw.Draw(temp_image)
-    
+
+def glyph_cases(char):
+    """Return the (char, case_prefix) images generated for a character.
+
+    Cased letters get a lowercase and an uppercase image; everything else,
+    including caseless letters such as CJK, gets a single symbol image.
+    """
+    if char.isalpha():
+        lower, upper = char.lower(), char.upper()
+        if lower != upper and len(lower) == 1 and len(upper) == 1:
+            return [(lower, 'L_'), (upper, 'U_')]
+    return [(char, 'S_')]
+
+
+def iter_glyph_jobs(characters, coverage=None):
+    """Yield (char, case_prefix) for every image generated from a character string.
+
+    With coverage (the code points of a font, see font_coverage), case
+    variants the font has no glyph for are left out, e.g. the uppercase of µ.
+    """
+    seen = set()
+    for char in characters:
+        for job in glyph_cases(char):
+            if job in seen or (coverage is not None and job[0] != ' ' and ord(job[0]) not in coverage):
+                continue
+            seen.add(job)
+            yield job
+
+
+def _glyph_scale(char, font, image_size):
+    """Return (em_scale, font_scale) used to size a character inside its cell"""
     # Determine target height based on character type
     if char.isupper() and char.isalpha():
         target_height = image_size * 0.7  # 70% of image height
@@ -203,13 +590,48 @@ def create_character_image(char, font, image_size, output_folder, case_prefix=''
     else:
         target_height = image_size * 0.5  # 50% of image height
         font_scale = 1.0
-    
+
     # Calculate scale factor based on em height
     em_scale = target_height / font.size
+    return em_scale, font_scale
+
+
+def scaled_font_size(char, font, image_size):
+    """Return the pixel size a character is rendered at inside its cell"""
+    em_scale, font_scale = _glyph_scale(char, font, image_size)
+    return int(font.size * em_scale * font_scale)
+
+
+def glyph_advance(char, font, image_size):
+    """Return the horizontal advance of a character at the size it is rendered in its cell"""
+    if char == ' ':
+        return image_size
+    scaled_font = rescaled_font(font, scaled_font_size(char, font, image_size))
+    return scaled_font.getlength(char)
+
+
+def glyph_origin_x(char, font, image_size):
+    """Return the x of the pen position a character is drawn at inside its cell"""
+    scaled_font = rescaled_font(font, scaled_font_size(char, font, image_size))
+    left, _, right, _ = scaled_font.getbbox(char)
+    return (image_size - (right - left)) // 2 - left
+
+
+def render_character_image(char, font, image_size):
+    """Render a single character into a square RGBA image of image_size"""
+    # Special case for space character
+    if char == ' ':
+        actual_width = image_size
+        return Image.new('RGBA', (actual_width, image_size), (0, 0, 0, 0))
+
+
+    # Get font metrics for proper sizing
+    ascent, descent = font.getmetrics()
+    
+    em_scale, font_scale = _glyph_scale(char, font, image_size)
     
     # Create scaled font
-    scaled_font_size = int(font.size * em_scale * font_scale)
-    scaled_font = ImageFont.truetype(font.path, scaled_font_size)
+    scaled_font = rescaled_font(font, scaled_font_size(char, font, image_size))
     
     # All characters will have the same width as image_size
     actual_width = image_size
@@ -238,107 +660,1187 @@ def create_character_image(char, font, image_size, output_folder, case_prefix=''
     else:
         y = baseline_y - int(ascent * em_scale)
     
-    print(f"Character: {char}")
-    print(f"Scale factor: {em_scale:.2f}")
-    print(f"Final dimensions - Width: {actual_width}, Height: {image_size}")
-    print(f"Position - X: {x}, Y: {y}")
+    logger.debug("Character %r: scale %.2f, %dx%d, position (%d, %d)", char, em_scale, actual_width, image_size, x, y)
     
     # Draw the character
     draw.text((x, y), char, fill='white', font=scaled_font)
-    
-    # Get character name and save
-    char_name = char_name_map.get(char, char)
-    filename = f"custom_font_{case_prefix}{char_name}"
-    filename = "".join(c if c.isalnum() else "_" for c in filename)
-    image.save(os.path.join(output_folder, f"{filename}.png"))
+    return image
 
 
-def generate_character_mapping(characters, output_folder):
-    """Generate character mapping in the custom format"""
-    mapping = "(InChar : char).ToImage():texture=\n    case(InChar):\n"
-    
-    for char in characters:
-        if char.isalpha():
-            # Get character names using the existing char_name_map from create_character_image
-            lower_char_name = char_name_map.get(char.lower(), char.lower())
-            upper_char_name = char_name_map.get(char.upper(), char.upper())
+# Distance field options used for any key an sdf config leaves out
+SDF_DEFAULTS = {'spread': 4, 'scale': 4}
 
 
-            # Lowercase mapping
-            mapping += f"        '{char.lower()}' => {output_folder}.custom_font_L_{lower_char_name}\n"
-            # Uppercase mapping
-            mapping += f"        '{char.upper()}' => {output_folder}.custom_font_U_{upper_char_name}\n"
-        else:
-            symbol_char_name = char_name_map.get(char, char)
-            mapping += f"        '{char}' => {output_folder}.custom_font_S_{symbol_char_name}\n"
-    
+def sdf_options(sdf):
+    """Return the full distance field options for an sdf config value (true or a dict)"""
+    return dict(SDF_DEFAULTS, **(sdf if isinstance(sdf, dict) else {}))
 
 
-    mapping += f"        _ => {output_folder}.custom_font_S_space\n"
-    # Write the mapping to a file
-    with open('../character_mapping.txt', 'w') as f:
-        f.write(mapping)
+def rasterize_glyph(char, font, image_size, sdf=None):
+    """render_character_image, timed and counted by the instrumentation.
 
+    With sdf the glyph is rendered scale times larger and turned into a signed
+    distance field of image_size (see postprocess.signed_distance_field).
+    """
+    options = sdf_options(sdf) if sdf else None
+    render_size = image_size * int(options['scale']) if options else image_size
+    with instrumentation.stage('rasterize'):
+        image = render_character_image(char, font, render_size)
+    instrumentation.count('glyphs_rendered')
+    if options:
+        from postprocess import distance_field_images
+        with instrumentation.stage('sdf'):
+            image = distance_field_images([image], float(options['spread']), int(options['scale']))[0]
+    return image
 
-def main():
-    # Load configuration
-    config = load_config()
 
-    # Create output folder if it doesn't exist
-    if not os.path.exists(config['output_folder']):
-        os.makedirs(config['output_folder'])
+def write_if_changed(path, data):
+    """Write bytes to path unless it already holds exactly those bytes, keeping its mtime stable"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                instrumentation.count('files_unchanged')
+                return False
+    except OSError:
+        pass
+    with instrumentation.stage('write'):
+        with open(path, 'wb') as f:
+            f.write(data)
+    instrumentation.count('files_written')
+    instrumentation.count('bytes_written', len(data))
+    return True
+
+
+def save_image(image, output_path, encoding=None):
+    """Encode an image as PNG (see encode_png) and write it only if the file content changes"""
+    with instrumentation.stage('encode'):
+        data = encode_png(image, encoding)
+    write_if_changed(output_path, data)
+    return output_path
+
+
+def create_character_image(char, font, image_size, output_folder, case_prefix='', encoding=None, mip_sizes=None,
+                           sdf=None):
+    """Render a single character and return the path of the saved image (mip_sizes: see save_glyph_images)"""
+    image = rasterize_glyph(char, font, image_size, sdf)
+    return save_glyph_images(image, os.path.join(output_folder, f"{glyph_filename(char, case_prefix)}.png"),
+                             image_size, encoding, mip_sizes)
+
+
+def mip_filename(name, size):
+    """Return the file name of the size-pixel mip of a glyph image file name"""
+    stem, extension = os.path.splitext(name)
+    return f"{stem}_{size}{extension}"
+
+
+def downsample_glyph(image, image_size, size):
+    """Scale a glyph rendered into an image_size cell down to a size cell"""
+    width = max(1, round(image.width * size / image_size))
+    height = max(1, round(image.height * size / image_size))
+    # Pillow premultiplies alpha while resampling RGBA, so edges do not pick up dark fringes
+    with instrumentation.stage('downsample'):
+        return image.resize((width, height), Image.LANCZOS)
+
+
+def save_glyph_images(image, output_path, image_size, encoding=None, mip_sizes=None):
+    """Save a glyph image plus a downsampled copy for every mip size, returning the main image's path"""
+    save_image(image, output_path, encoding)
+    for size in mip_sizes or ():
+        save_image(downsample_glyph(image, image_size, size), mip_filename(output_path, size), encoding)
+    return output_path
+
+
+def render_text_run(text, font, image_size, kerning=None, units_per_em=1000):
+    """Render a whole single-line string into one RGBA image image_size pixels tall.
+
+    Characters are drawn at the size and baseline of the lowercase glyph images
+    and placed by their advances plus the font's kerning (kerning maps two
+    characters to an adjustment in font units, as read by read_font_metrics).
+    The image is as wide as the run's advance or ink, whichever is wider.
+    """
+    if '\n' in text:
+        raise Exception(f"Text runs must be a single line: {text!r}")
+    kerning = kerning or {}
+    scaled_font = rescaled_font(font, scaled_font_size('a', font, image_size))
+    kerning_scale = scaled_font.size / units_per_em
+
+    # Pen position of every character
+    positions = []
+    pen_x = 0.0
+    for i, char in enumerate(text):
+        if i:
+            pen_x += kerning.get(text[i - 1] + char, 0) * kerning_scale
+        positions.append(pen_x)
+        pen_x += scaled_font.getlength(char)
+
+    boxes = [scaled_font.getbbox(char, anchor='ls') for char in text]
+    left = min([0.0] + [x + box[0] for x, box in zip(positions, boxes)])
+    right = max([pen_x] + [x + box[2] for x, box in zip(positions, boxes)])
+
+    image = Image.new('RGBA', (max(1, math.ceil(right - left)), image_size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    # Same baseline as the character images (20% from the bottom)
+    baseline_y = int(image_size * 0.8)
+    for char, x in zip(text, positions):
+        draw.text((x - left, baseline_y), char, fill='white', font=scaled_font, anchor='ls')
+    return image
+
+
+# Bump whenever render_character_image changes how glyphs look, so existing manifests go stale
+RENDER_VERSION = 1
+MANIFEST_FILENAME = '.font_manifest.json'
+
+# Digests of the most recently hashed font files, keyed on path, size and mtime
+FONT_DIGEST_CACHE_SIZE = 256
+_font_digests = OrderedDict()
+_font_digests_lock = threading.Lock()
+
+
+def font_file_digest(path):
+    """Return the SHA-256 of a font file, memoised on its size and mtime"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _font_digests_lock:
+        digest = _font_digests.get(key)
+        if digest is not None:
+            _font_digests.move_to_end(key)
+            return digest
+
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    with _font_digests_lock:
+        _font_digests[key] = digest
+        while len(_font_digests) > FONT_DIGEST_CACHE_SIZE:
+            _font_digests.popitem(last=False)
+    return digest
 
+
+def glyph_input_hash(font_digest, font_size, image_size, char, case_prefix, params=None):
+    """Hash everything that affects how a glyph image is rendered (params: any extra render options)"""
+    inputs = [RENDER_VERSION, font_digest, font_size, image_size, char, case_prefix, params]
+    return hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+
+def load_build_manifest(output_folder):
+    """Return the {file name: input hash} manifest of the last build in output_folder"""
     try:
-        # Download and load the Google Font
-        font_path = download_google_font(config['font_name'])
-        font = ImageFont.truetype(font_path, config['font_size'])
-    except Exception as e:
-        print(f"Error loading font: {e}")
-        print("Using default font instead.")
-        font = ImageFont.load_default()
+        with open(os.path.join(output_folder, MANIFEST_FILENAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    # Generate images for each character in both cases
-    for char in config['characters']:
-        if char.isalpha():
-            # Generate lowercase
-            create_character_image(
-                char.lower(),
-                font,
-                config['image_size'],
-                config['output_folder'],
-                'L_'
-            )
-            print(f"Generated image for character: {char.lower()}")
-
-            # Generate uppercase
-            create_character_image(
-                char.upper(),
-                font,
-                config['image_size'],
-                config['output_folder'],
-                'U_'
-            )
-            print(f"Generated image for character: {char.upper()}")
 
+def save_build_manifest(output_folder, manifest):
+    data = json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8')
+    write_if_changed(os.path.join(output_folder, MANIFEST_FILENAME), data)
+
+
+# Font loaded once per pool process by _init_render_worker
+_worker_font = None
+
+
+def _init_render_worker(font_path, font_size, variation=None):
+    global _worker_font
+    # Forked workers inherit the parent's numbers, which the parent already has
+    instrumentation.reset()
+    _worker_font = get_font(font_path, font_size, variation)
+
+
+def _call_with_worker_font(task):
+    # Worker timings travel back with each result so the parent sees the whole run
+    func, args = task
+    result = func(_worker_font, *args)
+    return result, instrumentation.drain()
+
+
+def _worker_context():
+    # Never fork: the Gradio server is threaded, and a child forked while another
+    # thread holds the instrumentation or font cache lock would deadlock
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def resolve_workers(workers):
+    """Turn a configured worker count into a process count (0 or None means one per CPU)"""
+    if not workers:
+        return os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+def imap_glyph_jobs(func, jobs, font, workers=1):
+    """Call func(font, *job) for every job, inline or across a process pool.
+
+    func must be a module-level function so it can be sent to pool workers,
+    which load the font once in their initializer. Results are yielded in job
+    order as soon as they are ready; closing the generator early cancels the
+    jobs that have not started yet.
+    """
+    workers = min(resolve_workers(workers), len(jobs))
+    font_path = getattr(font, 'path', None)
+
+    # Fonts without a file on disk (e.g. the default font) cannot be reloaded in a worker
+    if workers <= 1 or not isinstance(font_path, str):
+        for job in jobs:
+            yield func(font, *job)
+        return
+
+    tasks = [(func, job) for job in jobs]
+    chunksize = max(1, len(tasks) // (workers * 4))
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=_worker_context(), initializer=_init_render_worker,
+                               initargs=(font_path, font.size, getattr(font, 'variation', None)))
+    try:
+        for result, stats in pool.map(_call_with_worker_font, tasks, chunksize=chunksize):
+            instrumentation.merge(stats)
+            yield result
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def map_glyph_jobs(func, jobs, font, workers=1):
+    """Like imap_glyph_jobs, but returns every result as a list"""
+    return list(imap_glyph_jobs(func, jobs, font, workers))
+
+
+def _create_glyph_job(font, char, case_prefix, image_size, output_folder, encoding=None, mip_sizes=None, sdf=None):
+    return create_character_image(char, font, image_size, output_folder, case_prefix, encoding, mip_sizes, sdf)
+
+
+def _render_glyph_job(font, char, case_prefix, image_size, sdf=None):
+    return rasterize_glyph(char, font, image_size, sdf), glyph_advance(char, font, image_size)
+
+
+def _apply_effect_batch(batch, effects):
+    # NumPy is only imported once a run actually uses effects
+    from postprocess import apply_effects
+    with instrumentation.stage('postprocess'):
+        images = apply_effects([image for _, image in batch], effects)
+    return zip([key for key, _ in batch], images)
+
+
+def _iter_effect_batches(items, effects):
+    """Post-process (key, image) pairs in batches, yielding (key, processed image) in order"""
+    from postprocess import EFFECT_BATCH_SIZE
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == EFFECT_BATCH_SIZE:
+            yield from _apply_effect_batch(batch, effects)
+            batch = []
+    if batch:
+        yield from _apply_effect_batch(batch, effects)
+
+
+def _iter_created_glyphs(jobs, font, workers=1, effects=None):
+    """Render and save every (char, case_prefix, image_size, output_folder, encoding, mip_sizes, sdf) job, yielding saved paths.
+
+    Without effects each glyph is saved by the worker that rendered it; with
+    effects the rendered glyphs are post-processed in batches and saved here.
+    """
+    if not effects:
+        yield from imap_glyph_jobs(_create_glyph_job, jobs, font, workers)
+        return
+
+    render_jobs = [(char, case_prefix, image_size, sdf) for char, case_prefix, image_size, _, _, _, sdf in jobs]
+    rendered = imap_glyph_jobs(_render_glyph_job, render_jobs, font, workers)
+    items = ((job, image) for job, (image, _) in zip(jobs, rendered))
+    for (char, case_prefix, image_size, output_folder, encoding, mip_sizes, _), image in _iter_effect_batches(items, effects):
+        output_path = os.path.join(output_folder, f"{glyph_filename(char, case_prefix)}.png")
+        yield save_glyph_images(image, output_path, image_size, encoding, mip_sizes)
+
+
+def iter_render_characters(characters, font, image_size, output_folder, workers=1, incremental=True,
+                           effects=None, encoding=None, mip_sizes=None, sdf=None):
+    """Render every glyph for a character string, yielding (path, done, total) as glyphs finish.
+
+    In incremental mode a build manifest in output_folder records a hash of each
+    glyph's inputs; glyphs whose inputs are unchanged are not re-rendered (and
+    are yielded first), and images from the previous build that are no longer
+    generated are deleted. If the generator is closed early, the glyphs that
+    finished are still recorded in the manifest. effects are baked into every
+    glyph by postprocess.apply_effects and encoding is passed to encode_png.
+    When the encoding crops or deduplicates glyphs, the glyph index is updated
+    once every glyph is done; deduplicated glyphs yield their shared file.
+    mip_sizes are smaller cell sizes that every glyph is downsampled to from
+    the same rasterization, saved as <name>_<size>.png next to the image.
+    sdf renders signed distance fields instead of coverage (see rasterize_glyph).
+    """
+    encoding = encoding or {}
+    if sdf and effects:
+        raise Exception("Effects cannot be baked into SDF glyphs; draw outlines and shadows in the material")
+    mip_sizes = sorted(set(int(size) for size in mip_sizes or ()), reverse=True)
+    if any(size >= image_size or size < 1 for size in mip_sizes):
+        raise Exception(f"Mip sizes must be between 1 and the image size ({image_size}), got {mip_sizes}")
+    glyph_jobs = list(iter_glyph_jobs(characters, font_coverage(font)))
+    jobs = [(char, case_prefix, image_size, output_folder, encoding, mip_sizes, sdf) for char, case_prefix in glyph_jobs]
+    names = [f"{glyph_filename(char, case_prefix)}.png" for char, case_prefix in glyph_jobs]
+    # Every file written for a glyph, keyed on the name of its main image
+    glyph_files = {name: [name] + [mip_filename(name, size) for size in mip_sizes] for name in names}
+    all_names = [file for files in glyph_files.values() for file in files]
+    total = len(jobs)
+    uses_index = encoding.get('crop') or encoding.get('dedupe')
+
+    # Fonts without a file on disk cannot be hashed, so always render them in full
+    font_path = getattr(font, 'path', None)
+    if not incremental or not isinstance(font_path, str):
+        for done, path in enumerate(_iter_created_glyphs(jobs, font, workers, effects), 1):
+            yield path, done, total
+        if uses_index:
+            write_glyph_index(output_folder, all_names, encoding.get('dedupe'))
+        return
+
+    font_digest = font_file_digest(font_path)
+    params = {'effects': effects, 'encoding': encoding} if effects or encoding else None
+    if mip_sizes:
+        params = dict(params or {}, mip_sizes=mip_sizes)
+    if sdf:
+        params = dict(params or {}, sdf=sdf_options(sdf))
+    if getattr(font, 'variation', None) is not None:
+        params = dict(params or {}, variation=font.variation)
+    previous = load_build_manifest(output_folder)
+    previous_aliases = load_glyph_index(output_folder)['aliases'] if encoding.get('dedupe') else {}
+    hashes = {}
+    manifest = {}
+    for (char, case_prefix), name in zip(glyph_jobs, names):
+        glyph_hash = glyph_input_hash(font_digest, font.size, image_size, char, case_prefix, params)
+        for file in glyph_files[name]:
+            hashes[file] = glyph_hash
+            if previous.get(file) == glyph_hash and os.path.exists(os.path.join(output_folder, file)):
+                manifest[file] = glyph_hash
+
+    # A deduplicated glyph has no file of its own; it is current as long as the
+    # glyph it shares a file with is
+    aliases = {}
+    for name, target in previous_aliases.items():
+        if previous.get(name) == hashes.get(name) and target in manifest:
+            manifest[name] = hashes[name]
+            aliases[name] = target
+    current = [name for name in names if all(file in manifest for file in glyph_files[name])]
+    stale_jobs = [job for job, name in zip(jobs, names) if name not in current]
+
+    logger.info("%d of %d glyphs need rendering", len(stale_jobs), total)
+    instrumentation.count('glyphs_skipped', total - len(stale_jobs))
+    done = 0
+    completed = False
+    try:
+        for name in current:
+            done += 1
+            yield os.path.join(output_folder, aliases.get(name, name)), done, total
+        for path in _iter_created_glyphs(stale_jobs, font, workers, effects):
+            for file in glyph_files[os.path.basename(path)]:
+                manifest[file] = hashes[file]
+            done += 1
+            yield path, done, total
+        completed = True
+    finally:
+        if completed:
+            # Remove images from the previous build that are no longer generated
+            for name in set(previous) - set(manifest):
+                try:
+                    os.unlink(os.path.join(output_folder, name))
+                except OSError:
+                    pass
+            if uses_index:
+                write_glyph_index(output_folder, all_names, encoding.get('dedupe'), aliases)
         else:
-            create_character_image(
-                char,
-                font,
-                config['image_size'],
-                config['output_folder'],
-                'S_'
-            )
-            print(f"Generated image for character: {char}")
-
-    # Clean up the temporary font file
-    if 'font_path' in locals():
+            # Keep the old entries of unfinished glyphs so they still count as stale
+            # (and as known files) on the next run
+            manifest = dict(previous, **manifest)
+        save_build_manifest(output_folder, manifest)
+
+
+def render_characters(characters, font, image_size, output_folder, workers=1, incremental=True, effects=None,
+                      encoding=None, mip_sizes=None, sdf=None):
+    """Render every glyph for a character string, optionally across a process pool.
+
+    Returns the image paths in character order, whatever the worker count.
+    See iter_render_characters for how incremental mode, effects and encoding work.
+    """
+    for _ in iter_render_characters(characters, font, image_size, output_folder, workers, incremental,
+                                    effects, encoding, mip_sizes, sdf):
+        pass
+    aliases = load_glyph_index(output_folder)['aliases'] if (encoding or {}).get('dedupe') else {}
+    names = [f"{glyph_filename(char, case_prefix)}.png"
+             for char, case_prefix in iter_glyph_jobs(characters, font_coverage(font))]
+    return [os.path.join(output_folder, aliases.get(name, name)) for name in names]
+
+
+GLYPH_INDEX_FILENAME = 'custom_font_glyphs.json'
+# PNG text chunk holding "x,y,cell width,cell height" of a cropped glyph
+GLYPH_OFFSET_KEY = 'verse_font_offset'
+
+
+def encode_png(image, encoding=None):
+    """Encode a glyph image as PNG bytes.
+
+    encoding is a dict with any of:
+      crop: crop to the ink bbox, storing the offset in the PNG's GLYPH_OFFSET_KEY text chunk
+      mode: 'rgba' (default), 'la' (gray + alpha), 'alpha' (single channel) or 'palette'
+      colors: palette size for the palette mode (default 256)
+      compress_level: zlib level from 0 to 9 (default 6)
+      optimize: let the PNG encoder search for the smallest output
+    """
+    encoding = encoding or {}
+    pnginfo = None
+    if encoding.get('crop'):
+        cell_width, cell_height = image.size
+        # Fully transparent glyphs (e.g. space) keep a single pixel
+        bbox = image.getchannel('A').getbbox() or (0, 0, 1, 1)
+        image = image.crop(bbox)
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text(GLYPH_OFFSET_KEY, f"{bbox[0]},{bbox[1]},{cell_width},{cell_height}")
+
+    mode = encoding.get('mode', 'rgba')
+    if mode == 'la':
+        image = image.convert('LA')
+    elif mode == 'alpha':
+        image = image.getchannel('A')
+    elif mode == 'palette':
+        image = image.quantize(colors=encoding.get('colors', 256), method=Image.Quantize.FASTOCTREE)
+    elif mode != 'rgba':
+        raise Exception(f"Unknown PNG encoding mode: {mode}")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=encoding.get('compress_level', 6),
+               optimize=encoding.get('optimize', False), pnginfo=pnginfo)
+    return buffer.getvalue()
+
+
+def load_glyph_index(output_folder):
+    """Return the crop offsets and aliases written by write_glyph_index"""
+    try:
+        with open(os.path.join(output_folder, GLYPH_INDEX_FILENAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'glyphs': {}, 'aliases': {}}
+
+
+def write_glyph_index(output_folder, names, dedupe=False, aliases=None):
+    """Deduplicate identical glyph files and record crop offsets and aliases in the glyph index.
+
+    names are every generated file name in order. aliases are the still valid
+    aliases from the previous run, whose files are already gone. With dedupe,
+    every file identical to an earlier one is deleted and becomes an alias of it.
+    """
+    aliases = dict(aliases or {})
+    first_by_digest = {}
+    glyphs = {}
+    for name in names:
+        if name in aliases:
+            continue
+        path = os.path.join(output_folder, name)
         try:
-            os.unlink(font_path)
-        except:
-            pass
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            continue
+        if dedupe:
+            digest = hashlib.sha256(data).hexdigest()
+            if digest in first_by_digest:
+                aliases[name] = first_by_digest[digest]
+                os.unlink(path)
+                continue
+            first_by_digest[digest] = name
+        with Image.open(io.BytesIO(data)) as image:
+            offset = image.text.get(GLYPH_OFFSET_KEY)
+        if offset:
+            glyphs[name] = [int(value) for value in offset.split(',')]
+
+    # An alias may point at a file that has itself just been deduplicated
+    for name, target in aliases.items():
+        while target in aliases:
+            target = aliases[target]
+        aliases[name] = target
+
+    index = {'fields': ['x', 'y', 'cell_w', 'cell_h'], 'glyphs': glyphs, 'aliases': aliases}
+    data = json.dumps(index, ensure_ascii=False, indent=1, sort_keys=True).encode('utf-8')
+    write_if_changed(os.path.join(output_folder, GLYPH_INDEX_FILENAME), data)
+    return index
+
+
+def _next_power_of_two(value):
+    size = 1
+    while size < value:
+        size *= 2
+    return size
+
+
+def _pack_shelves(sizes, page_width, page_height, padding):
+    """Place (width, height) boxes on shelves, opening new pages when one fills up.
+
+    sizes must already be sorted tallest first. Returns a list of
+    (page, x, y) placements in the same order, or None if a box can never fit.
+    """
+    placements = []
+    page = x = y = shelf_height = 0
+    for width, height in sizes:
+        padded_width, padded_height = width + padding, height + padding
+        if padded_width > page_width or padded_height > page_height:
+            return None
+        if x + padded_width > page_width:
+            # Start a new shelf below the current one
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        if y + padded_height > page_height:
+            page += 1
+            x = y = shelf_height = 0
+        placements.append((page, x, y))
+        x += padded_width
+        shelf_height = max(shelf_height, padded_height)
+    return placements
+
+
+def build_glyph_atlas(glyphs, max_size=2048, padding=2):
+    """Pack glyph images into as few power-of-two sheets as possible.
+
+    glyphs is a list of (char, name, image, advance). Each image is trimmed
+    to its ink before packing; the offset of the trimmed rect inside the
+    original cell is kept so layout can reproduce the fixed-size cell.
+    Returns (pages, entries) where pages are RGBA images and entries are
+    dicts in glyph order.
+    """
+    trimmed = []
+    for char, name, image, advance in glyphs:
+        bbox = image.getchannel('A').getbbox() or (0, 0, 0, 0)
+        trimmed.append((char, name, image.crop(bbox), bbox, image.size, advance))
+
+    order = sorted(range(len(trimmed)), key=lambda i: (-trimmed[i][2].height, -trimmed[i][2].width))
+    sizes = [trimmed[i][2].size for i in order]
+    total_area = sum((w + padding) * (h + padding) for w, h in sizes)
+
+    # Grow a single sheet (alternating width and height) until everything fits,
+    # and only spill onto several max_size sheets once that stops working
+    width = height = min(max_size, _next_power_of_two(max(1, int(total_area ** 0.5))))
+    while True:
+        placements = _pack_shelves(sizes, width, height, padding)
+        if placements is not None and all(page == 0 for page, _, _ in placements):
+            break
+        if width >= max_size and height >= max_size:
+            placements = _pack_shelves(sizes, max_size, max_size, padding)
+            if placements is None:
+                raise Exception(f"Glyph larger than the maximum atlas size of {max_size}px")
+            break
+        if width <= height:
+            width = min(max_size, width * 2)
+        else:
+            height = min(max_size, height * 2)
+
+    page_count = max((page for page, _, _ in placements), default=0) + 1
+    page_heights = [1] * page_count
+    for (page, _, y), (_, h) in zip(placements, sizes):
+        page_heights[page] = max(page_heights[page], y + h + padding)
+    pages = [Image.new('RGBA', (width, min(height, _next_power_of_two(page_height))), (0, 0, 0, 0))
+             for page_height in page_heights]
+
+    entries = [None] * len(trimmed)
+    for index, (page, x, y) in zip(order, placements):
+        char, name, crop, bbox, cell_size, advance = trimmed[index]
+        page_image = pages[page]
+        page_image.paste(crop, (x, y))
+        entries[index] = {
+            'char': char,
+            'name': name,
+            'page': page,
+            'x': x,
+            'y': y,
+            'w': crop.width,
+            'h': crop.height,
+            'u0': x / page_image.width,
+            'v0': y / page_image.height,
+            'u1': (x + crop.width) / page_image.width,
+            'v1': (y + crop.height) / page_image.height,
+            'offset_x': bbox[0],
+            'offset_y': bbox[1],
+            'cell_w': cell_size[0],
+            'cell_h': cell_size[1],
+            'advance': round(advance, 2),
+        }
+    return pages, entries
+
+
+# Binary index layout: header, then one record per glyph
+ATLAS_INDEX_MAGIC = b'VFA1'
+ATLAS_INDEX_HEADER = struct.Struct('<4sHHH')  # magic, page count, glyph count, cell size
+ATLAS_INDEX_RECORD = struct.Struct('<IBHHHHhhf')  # codepoint, page, x, y, w, h, offset x/y, advance
+
+
+def write_atlas_index(pages, entries, output_folder, image_size, index_format='json'):
+    """Write the atlas index as compact JSON or as a packed binary file and return its path.
+
+    Glyph offsets are relative to the glyph's cell, which is larger than
+    image_size when effects pad the glyphs, so the cell size is written too
+    (the binary header stores the cell size).
+    """
+    cell_width, cell_height = (entries[0]['cell_w'], entries[0]['cell_h']) if entries else (image_size, image_size)
+    if index_format == 'binary':
+        index_path = os.path.join(output_folder, 'custom_font_atlas.bin')
+        with open(index_path, 'wb') as f:
+            f.write(ATLAS_INDEX_HEADER.pack(ATLAS_INDEX_MAGIC, len(pages), len(entries), cell_width))
+            for page in pages:
+                f.write(struct.pack('<HH', page.width, page.height))
+            for entry in entries:
+                f.write(ATLAS_INDEX_RECORD.pack(
+                    ord(entry['char']), entry['page'], entry['x'], entry['y'], entry['w'], entry['h'],
+                    entry['offset_x'], entry['offset_y'], entry['advance']
+                ))
+        return index_path
+
+    index = {
+        'image_size': image_size,
+        'cell_size': [cell_width, cell_height],
+        'pages': [{'file': f"custom_font_atlas_{i}.png", 'width': page.width, 'height': page.height}
+                  for i, page in enumerate(pages)],
+        'glyphs': {entry['char']: [entry['page'], entry['x'], entry['y'], entry['w'], entry['h'],
+                                   entry['offset_x'], entry['offset_y'], entry['advance']]
+                   for entry in entries},
+        'fields': ['page', 'x', 'y', 'w', 'h', 'offset_x', 'offset_y', 'advance'],
+    }
+    index_path = os.path.join(output_folder, 'custom_font_atlas.json')
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+    return index_path
+
+
+def verse_char_literal(char):
+    """Return a Verse literal for a character: a quoted char for ASCII, a char32 code point otherwise"""
+    if not char.isascii():
+        return f"0u{ord(char):04X}"
+    if char in "\\'{}":
+        return f"'\\{char}'"
+    return f"'{char}'"
+
+
+def verse_string_literal(text):
+    """Return a Verse string literal for text, escaping the characters Verse reserves"""
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('{', '\\{').replace('}', '\\}') + '"'
+
+
+def iter_verse_char_lookup(function, value_type, items, default, table=None):
+    """Yield the lines of Verse functions mapping characters to values.
+
+    items are (char, value) pairs. Verse strings are UTF-8, so ASCII characters
+    are matched as char and everything else by an overload taking a char32,
+    which is only emitted when there are such characters.
+
+    By default each function is one case with a branch per character. With a
+    table name the values go into a map constant (<table>, and <table>Wide for
+    char32) built once, and the function is a single lookup, so its cost and
+    size stay flat however many characters there are.
+    """
+    items = list(items)
+    groups = [('char', table, [item for item in items if item[0].isascii()])]
+    wide = [item for item in items if not item[0].isascii()]
+    if wide:
+        groups.append(('char32', f"{table}Wide" if table else None, wide))
+    for i, (char_type, name, group) in enumerate(groups):
+        if i:
+            yield ""
+        if name:
+            yield f"{name} : [{char_type}]{value_type} = map{{"
+            for j, (char, value) in enumerate(group):
+                separator = "," if j < len(group) - 1 else ""
+                yield f"    {verse_char_literal(char)} => {value}{separator}"
+            yield "}"
+            yield ""
+            yield f"(InChar : {char_type}).{function}:{value_type}="
+            yield f"    if (Value := {name}[InChar]) then Value else {default}"
+        else:
+            yield f"(InChar : {char_type}).{function}:{value_type}="
+            yield "    case(InChar):"
+            for char, value in group:
+                yield f"        {verse_char_literal(char)} => {value}"
+            yield f"        _ => {default}"
+
+
+# Values of the mapping_lookup config key: one case per function, or map constants
+MAPPING_LOOKUPS = ('case', 'table')
+
+
+def _lookup_table(lookup, name):
+    """Return the map constant name to use for a lookup style, or None for a case"""
+    if lookup not in MAPPING_LOOKUPS:
+        raise Exception(f"Unknown mapping_lookup '{lookup}', expected one of {', '.join(MAPPING_LOOKUPS)}")
+    return name if lookup == 'table' else None
+
+
+def generate_atlas_mapping(entries, pages, output_folder, mapping_path='../character_mapping.txt', lookup='case'):
+    """Generate the Verse lookup that maps characters to atlas pages and UV rects (lookup: 'case' or 'table')"""
+    lines = [
+        "custom_font_atlas_glyph := struct:",
+        "    Page : int = 0",
+        "    U0 : float = 0.0",
+        "    V0 : float = 0.0",
+        "    U1 : float = 0.0",
+        "    V1 : float = 0.0",
+        "    OffsetX : float = 0.0",
+        "    OffsetY : float = 0.0",
+        "    Width : float = 0.0",
+        "    Height : float = 0.0",
+        "    Advance : float = 0.0",
+        "",
+        "(InPage : int).ToAtlasPage():texture=",
+        "    case(InPage):",
+    ]
+    for i in range(1, len(pages)):
+        lines.append(f"        {i} => {output_folder}.custom_font_atlas_{i}")
+    lines.append(f"        _ => {output_folder}.custom_font_atlas_0")
+    lines.append("")
+    glyphs = (
+        (entry['char'],
+         f"custom_font_atlas_glyph{{"
+         f"Page := {entry['page']}, "
+         f"U0 := {entry['u0']:.6f}, V0 := {entry['v0']:.6f}, "
+         f"U1 := {entry['u1']:.6f}, V1 := {entry['v1']:.6f}, "
+         f"OffsetX := {float(entry['offset_x'])}, OffsetY := {float(entry['offset_y'])}, "
+         f"Width := {float(entry['w'])}, Height := {float(entry['h'])}, "
+         f"Advance := {float(entry['advance'])}}}")
+        for entry in entries
+    )
+    lines.extend(iter_verse_char_lookup("ToAtlasGlyph()", "custom_font_atlas_glyph", glyphs, "custom_font_atlas_glyph{}",
+                                        _lookup_table(lookup, "CustomFontAtlasGlyphs")))
+    mapping = "\n".join(lines) + "\n"
+
+    write_if_changed(mapping_path, mapping.encode('utf-8'))
+    return mapping
+
+
+def render_atlas(characters, font, image_size, output_folder, workers=1,
+                 max_size=2048, padding=2, index_format='json', mapping_path='../character_mapping.txt',
+                 effects=None, encoding=None, sdf=None, lookup='case'):
+    """Render every glyph into packed atlas sheets plus an index and Verse lookup.
+
+    Returns the paths of the saved atlas pages.
+    """
+    glyph_jobs = list(iter_glyph_jobs(characters, font_coverage(font)))
+    if effects and sdf:
+        raise Exception("Effects cannot be baked into SDF glyphs; draw outlines and shadows in the material")
+    jobs = [(char, case_prefix, image_size, sdf) for char, case_prefix in glyph_jobs]
+    rendered = map_glyph_jobs(_render_glyph_job, jobs, font, workers)
+
+    if effects:
+        images = [image for _, image in _iter_effect_batches(
+            ((i, image) for i, (image, _) in enumerate(rendered)), effects)]
+        rendered = [(image, advance) for image, (_, advance) in zip(images, rendered)]
+
+    glyphs = [(char, glyph_filename(char, case_prefix), image, advance)
+              for (char, case_prefix), (image, advance) in zip(glyph_jobs, rendered)]
+    with instrumentation.stage('pack'):
+        pages, entries = build_glyph_atlas(glyphs, max_size, padding)
+
+    page_paths = []
+    for i, page in enumerate(pages):
+        page_path = os.path.join(output_folder, f"custom_font_atlas_{i}.png")
+        # Sheets are already packed tightly, so only the PNG format options apply
+        save_image(page, page_path, dict(encoding or {}, crop=False))
+        page_paths.append(page_path)
+    with instrumentation.stage('mapping'):
+        write_atlas_index(pages, entries, output_folder, image_size, index_format)
+        generate_atlas_mapping(entries, pages, output_folder, mapping_path, lookup)
+    return page_paths
+
+def build_metrics_table(font, characters, image_size):
+    """Build the metrics table of every generated glyph.
+
+    Font-unit metrics come from metrics.read_font_metrics; each glyph also gets
+    a 'cell' entry with the same metrics in pixels at the size it is rendered
+    inside its image_size cell, plus origin_x, the pen position in that cell.
+    Kerning is converted to pixels at the size of the left character.
+    """
+    from metrics import read_font_metrics
+    chars = [char for char, _ in iter_glyph_jobs(characters, font_coverage(font))]
+    table = read_font_metrics(font.path, chars, getattr(font, 'variation', None))
+    units_per_em = table['units_per_em']
+    table['image_size'] = image_size
+
+    pixels_per_unit = {}
+    for char, glyph in table['glyphs'].items():
+        scale = pixels_per_unit[char] = scaled_font_size(char, font, image_size) / units_per_em
+        bbox = glyph['bbox']
+        glyph['cell'] = {
+            'advance': round(glyph['advance'] * scale, 2),
+            'lsb': round(glyph['lsb'] * scale, 2),
+            'origin_x': glyph_origin_x(char, font, image_size) if char != ' ' else
+            round((image_size - glyph['advance'] * scale) / 2, 2),
+            'ink': [round(value * scale, 2) for value in bbox] if bbox else None,
+        }
+    table['cell_kerning'] = {pair: round(value * pixels_per_unit[pair[0]], 2)
+                             for pair, value in table['kerning'].items()}
+    return table
+
+
+def generate_metrics_mapping(table, output_path='../character_metrics.txt', lookup='case'):
+    """Generate the Verse lookup for glyph metrics and kerning (lookup: 'case' or 'table').
+
+    Values are fractions of the glyph cell, so multiplying them by the
+    widget's font size gives UI units.
+    """
+    image_size = table['image_size']
+
+    def cell(value):
+        return f"{value / image_size:.4f}"
+
+    lines = [
+        "custom_font_glyph_metrics := struct:",
+        "    Advance : float = 1.0",
+        "    OriginX : float = 0.0",
+        "    InkLeft : float = 0.0",
+        "    InkRight : float = 1.0",
+        "",
+    ]
+
+    def glyph_metrics(metrics):
+        ink_left, ink_right = (metrics['ink'][0], metrics['ink'][2]) if metrics['ink'] else (0, 0)
+        return (f"custom_font_glyph_metrics{{"
+                f"Advance := {cell(metrics['advance'])}, OriginX := {cell(metrics['origin_x'])}, "
+                f"InkLeft := {cell(metrics['origin_x'] + ink_left)}, InkRight := {cell(metrics['origin_x'] + ink_right)}}}")
+
+    glyphs = ((char, glyph_metrics(glyph['cell'])) for char, glyph in table['glyphs'].items())
+    lines.extend(iter_verse_char_lookup("ToGlyphMetrics()", "custom_font_glyph_metrics", glyphs,
+                                        "custom_font_glyph_metrics{}", _lookup_table(lookup, "CustomFontGlyphMetrics")))
+
+    # Kerning pairs are keyed on the two characters as a string
+    lines += ["", "CustomFontKerning : [string]float = map{"]
+    pairs = list(table['cell_kerning'].items())
+    for i, (pair, value) in enumerate(pairs):
+        separator = "," if i < len(pairs) - 1 else ""
+        lines.append(f'    {verse_string_literal(pair)} => {cell(value)}{separator}')
+    lines += [
+        "}",
+        "",
+        "GetKerning(InLeft : char, InRight : char):float=",
+        "    if (Kerning := CustomFontKerning[\"{InLeft}{InRight}\"]) then Kerning else 0.0",
+    ]
+    mapping = "\n".join(lines) + "\n"
+
+    write_if_changed(output_path, mapping.encode('utf-8'))
+    return mapping
+
+
+def write_metrics(font, characters, image_size, output_folder, metrics_mapping_path='../character_metrics.txt',
+                  lookup='case'):
+    """Write custom_font_metrics.json and the Verse metrics lookup for a font, returning the table"""
+    table = build_metrics_table(font, characters, image_size)
+    data = json.dumps(table, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    write_if_changed(os.path.join(output_folder, 'custom_font_metrics.json'), data)
+    generate_metrics_mapping(table, metrics_mapping_path, lookup)
+    return table
+
+def text_run_names(texts):
+    """Return {text: image file name (without extension)} for the strings of text_runs.
+
+    Names are built from the text; a name already taken by an earlier string
+    gets a short hash of its text appended.
+    """
+    names = {}
+    taken = set()
+    for text in texts:
+        if text in names:
+            continue
+        slug = "".join(c if c.isascii() and c.isalnum() else "_" for c in text)[:40].strip("_") or "run"
+        name = f"custom_font_text_{slug}"
+        if name in taken:
+            name = f"{name}_{hashlib.sha1(text.encode('utf-8')).hexdigest()[:8]}"
+        names[text] = name
+        taken.add(name)
+    return names
+
+
+def _text_run_job(font, text, image_size, output_path, kerning, units_per_em, effects=None, encoding=None, sdf=None):
+    options = sdf_options(sdf) if sdf else None
+    scale = int(options['scale']) if options else 1
+    with instrumentation.stage('rasterize'):
+        image = render_text_run(text, font, image_size * scale, kerning, units_per_em)
+    instrumentation.count('text_runs_rendered')
+    if options:
+        # The distance field is reduced by whole scale x scale blocks
+        padded = Image.new('RGBA', (math.ceil(image.width / scale) * scale, image.height), (0, 0, 0, 0))
+        padded.paste(image, (0, 0))
+        from postprocess import distance_field_images
+        with instrumentation.stage('sdf'):
+            image = distance_field_images([padded], float(options['spread']), scale)[0]
+    if effects:
+        image = next(_apply_effect_batch([(text, image)], effects))[1]
+    return save_image(image, output_path, encoding)
+
+
+def render_text_runs(texts, font, image_size, output_folder, workers=1, mapping_path='../text_run_mapping.txt',
+                     effects=None, encoding=None, sdf=None, lookup='case'):
+    """Render every string of texts into its own image plus a Verse lookup of them.
+
+    All runs share one font instance and its kerning table (see render_text_run).
+    Returns the paths of the saved images.
+    """
+    if effects and sdf:
+        raise Exception("Effects cannot be baked into SDF glyphs; draw outlines and shadows in the material")
+    from metrics import read_font_metrics
+    names = text_run_names(texts)
+    metrics = read_font_metrics(font.path, "".join(names), getattr(font, 'variation', None))
+    jobs = []
+    for text, name in names.items():
+        # Only send each run the kerning pairs it uses
+        kerning = {pair: metrics['kerning'][pair] for pair in (text[i:i + 2] for i in range(len(text) - 1))
+                   if pair in metrics['kerning']}
+        jobs.append((text, image_size, os.path.join(output_folder, f"{name}.png"), kerning,
+                     metrics['units_per_em'], effects, encoding, sdf))
+    paths = map_glyph_jobs(_text_run_job, jobs, font, workers)
+
+    widths = {}
+    for text, path in zip(names, paths):
+        with Image.open(path) as image:
+            widths[text] = image.width / image.height
+    with instrumentation.stage('mapping'):
+        generate_text_run_mapping(names, widths, output_folder, mapping_path, lookup)
+    return paths
+
+
+def generate_text_run_mapping(names, widths, output_folder, mapping_path='../text_run_mapping.txt', lookup='case'):
+    """Generate the Verse lookup from label strings to their pre-rendered images.
+
+    Width is the image width in multiples of its height, so a run drawn at
+    font size S wants a desired size of S * Width by S.
+    """
+    lines = [
+        "custom_font_text_run := struct:",
+        "    Image : texture",
+        "    Width : float = 1.0",
+        "",
+    ]
+    runs = [(text, f"custom_font_text_run{{Image := {output_folder}.{name}, Width := {widths[text]:.4f}}}")
+            for text, name in names.items()]
+    table = _lookup_table(lookup, "CustomFontTextRuns")
+    if table:
+        lines.append(f"{table} : [string]custom_font_text_run = map{{")
+        for i, (text, run) in enumerate(runs):
+            separator = "," if i < len(runs) - 1 else ""
+            lines.append(f"    {verse_string_literal(text)} => {run}{separator}")
+        lines += [
+            "}",
+            "",
+            "GetTextRun(InText : string):?custom_font_text_run=",
+            f"    if (Run := {table}[InText]) then option{{Run}} else false",
+        ]
+    else:
+        # Strings cannot be matched by a case, so compare them in turn
+        lines.append("GetTextRun(InText : string):?custom_font_text_run=")
+        for i, (text, run) in enumerate(runs):
+            keyword = "if" if i == 0 else "else if"
+            lines.append(f"    {keyword} (InText = {verse_string_literal(text)}):")
+            lines.append(f"        option{{{run}}}")
+        if runs:
+            lines.append("    else:")
+            lines.append("        false")
+        else:
+            lines.append("    false")
+    mapping = "\n".join(lines) + "\n"
+
+    write_if_changed(mapping_path, mapping.encode('utf-8'))
+    return mapping
+
+
+def mip_threshold(smaller, larger):
+    """Return the font size at which the selector switches between two mip sizes (their geometric mean)"""
+    return (smaller * larger) ** 0.5
+
+
+def iter_mip_selector(char_types, image_size, mip_sizes):
+    """Yield the Verse lines of ToImage(InFontSize) overloads that pick the nearest mip size"""
+    sizes = sorted(mip_sizes) + [image_size]
+    for char_type in char_types:
+        yield ""
+        yield f"(InChar : {char_type}).ToImage(InFontSize : float):texture="
+        for i, size in enumerate(sizes[:-1]):
+            keyword = "if" if i == 0 else "else if"
+            yield f"    {keyword} (InFontSize <= {mip_threshold(size, sizes[i + 1]):.2f}):"
+            yield f"        InChar.ToImage{size}()"
+        yield "    else:"
+        yield "        InChar.ToImage()"
+
+
+def generate_character_mapping(characters, output_folder, mapping_path='../character_mapping.txt', aliases=None,
+                               image_size=None, mip_sizes=None, lookup='case', coverage=None):
+    """Generate character mapping in the custom format (aliases: deduplicated file names, see write_glyph_index).
+
+    coverage leaves out the case variants the font cannot draw, as in iter_glyph_jobs.
+
+    With mip_sizes, a ToImage<size>() lookup is written for every mip size plus
+    a ToImage(InFontSize) selector that picks the size nearest to the font size.
+    lookup is 'case' or 'table' (see iter_verse_char_lookup).
+    """
+    aliases = aliases or {}
+    mip_sizes = sorted(set(int(size) for size in mip_sizes or ()), reverse=True)
+
+    def image_name(file_name):
+        # Deduplicated glyphs point at the file they share
+        return f"{output_folder}.{os.path.splitext(aliases.get(file_name, file_name))[0]}"
+
+    # One entry per image, built as a list of lines so large sets stay linear
+    images = {}
+    for char, case_prefix in iter_glyph_jobs(characters, coverage):
+        images.setdefault(char, f"{glyph_filename(char, case_prefix)}.png")
+    default = "custom_font_S_space.png"
+    lines = list(iter_verse_char_lookup(
+        "ToImage()", "texture", ((char, image_name(name)) for char, name in images.items()), image_name(default),
+        _lookup_table(lookup, "CustomFontImages")
+    ))
+    for size in mip_sizes:
+        lines.append("")
+        lines.extend(iter_verse_char_lookup(
+            f"ToImage{size}()", "texture",
+            ((char, image_name(mip_filename(name, size))) for char, name in images.items()),
+            image_name(mip_filename(default, size)),
+            _lookup_table(lookup, f"CustomFontImages{size}")
+        ))
+    if mip_sizes:
+        char_types = ['char'] + (['char32'] if any(not char.isascii() for char in images) else [])
+        lines.extend(iter_mip_selector(char_types, image_size, mip_sizes))
+    mapping = "\n".join(lines) + "\n"
+
+    # Write the mapping to a file
+    write_if_changed(mapping_path, mapping.encode('utf-8'))
+    return mapping
+
+
+def generate_font_output(config, font, mapping_path='../character_mapping.txt'):
+    """Render one configured character set with a loaded font and write its mapping.
+
+    Uses the same keys as config.json. Returns the paths of the written images.
+    """
+    # Resolve Unicode ranges up front and leave out what the font cannot draw
+    config = dict(config, characters=covered_characters(expand_characters(config['characters']), font))
+    output_folder = config['output_folder']
+    os.makedirs(output_folder, exist_ok=True)
+
+    if config.get('output_mode', 'images') == 'atlas':
+        if config.get('mip_sizes'):
+            logger.warning("mip_sizes only applies to the images output mode and is ignored for atlases")
+        write_config_metrics(config, font, mapping_path)
+        write_config_text_runs(config, font, mapping_path)
+        # Pack every glyph into atlas sheets, with the index and Verse lookup alongside
+        return render_atlas(
+            config['characters'],
+            font,
+            config['image_size'],
+            output_folder,
+            config.get('workers', 1),
+            config.get('atlas_max_size', 2048),
+            config.get('atlas_padding', 2),
+            config.get('atlas_index_format', 'json'),
+            mapping_path,
+            config.get('effects'),
+            config.get('encoding'),
+            config.get('sdf'),
+            config.get('mapping_lookup', 'case')
+        )
+
+    # Generate images for each character in both cases
+    paths = render_characters(
+        config['characters'],
+        font,
+        config['image_size'],
+        output_folder,
+        config.get('workers', 1),
+        config.get('incremental', True),
+        config.get('effects'),
+        config.get('encoding'),
+        config.get('mip_sizes'),
+        config.get('sdf')
+    )
 
     # After generating all images, create the mapping
-    generate_character_mapping(config['characters'], config['output_folder'])
+    aliases = load_glyph_index(output_folder)['aliases'] if (config.get('encoding') or {}).get('dedupe') else None
+    with instrumentation.stage('mapping'):
+        generate_character_mapping(config['characters'], output_folder, mapping_path, aliases,
+                                   config['image_size'], config.get('mip_sizes'), config.get('mapping_lookup', 'case'),
+                                   font_coverage(font))
+    write_config_metrics(config, font, mapping_path)
+    write_config_text_runs(config, font, mapping_path)
+    return paths
+
+
+def generate_font_instances(config, mapping_path='../character_mapping.txt', instances=None):
+    """Render every font_instances entry of a config, all from one loaded variable font.
+
+    Outputs are namespaced per instance: the glyphs go to
+    <output_folder>_<instance> and the mapping (with the metrics and text run
+    lookups) to an <instance> folder next to mapping_path. Returns
+    {instance name: written paths}. instances may be passed in when already
+    resolved with resolve_font_instances.
+    """
+    outputs = {}
+    instances = instances or resolve_font_instances(config)
+    with contextlib.ExitStack() as stack:
+        # Keep every instance's font in the download cache until all are rendered
+        for font_path in set(font_path for _, font_path, _ in instances):
+            stack.enter_context(download_cache.in_use(font_path))
+        for name, font_path, variation in instances:
+            logger.info("Rendering font instance %s", name)
+            font = get_font(font_path, config['font_size'], variation)
+            instance_config = dict(config, output_folder=f"{config['output_folder']}_{name}")
+            instance_mapping_path = os.path.join(os.path.dirname(mapping_path), name, os.path.basename(mapping_path))
+            os.makedirs(os.path.dirname(instance_mapping_path), exist_ok=True)
+            outputs[name] = generate_font_output(instance_config, font, instance_mapping_path)
+    return outputs
+
+
+def write_config_metrics(config, font, mapping_path):
+    """Write the metrics table next to the mapping when the config asks for it"""
+    if not config.get('metrics') or not isinstance(getattr(font, 'path', None), str):
+        return None
+    metrics_mapping_path = os.path.join(os.path.dirname(mapping_path), 'character_metrics.txt')
+    with instrumentation.stage('metrics'):
+        return write_metrics(font, config['characters'], config['image_size'], config['output_folder'],
+                             metrics_mapping_path, config.get('mapping_lookup', 'case'))
+
+
+def write_config_text_runs(config, font, mapping_path):
+    """Pre-render the config's text_runs next to the glyphs, with their lookup next to the mapping"""
+    if not config.get('text_runs'):
+        return None
+    if not isinstance(getattr(font, 'path', None), str):
+        logger.warning("Text runs need a font file and are skipped for the default font")
+        return None
+    text_run_mapping_path = os.path.join(os.path.dirname(mapping_path), 'text_run_mapping.txt')
+    return render_text_runs(config['text_runs'], font, config['image_size'], config['output_folder'],
+                            config.get('workers', 1), text_run_mapping_path, config.get('effects'),
+                            config.get('encoding'), config.get('sdf'), config.get('mapping_lookup', 'case'))
+
+
+def main():
+    # Load configuration
+    config = load_config()
+
+    configure_logging(config.get('log_level', 'INFO'))
+    configure_download_cache(config)
+    configure_http_client(config)
+
+    with profiled(config.get('profile')):
+        if config.get('font_instances'):
+            # Several weights/widths of one (variable) font, each in its own folder
+            generate_font_instances(config)
+        else:
+            try:
+                # A local font file skips Google Fonts (and the network) entirely
+                font_path = config.get('font_path')
+                if not font_path:
+                    # Download (or reuse the cached copy of) the Google Font
+                    font_path = download_google_font(config['font_name'], config.get('font_weight', 400),
+                                                     subset=config.get('font_subsets', 'latin'),
+                                                     offline=config.get('offline', False),
+                                                     test_image=config.get('font_test_image'))
+                font = get_font(font_path, config['font_size'])
+            except Exception as e:
+                logger.error("Error loading font: %s", e)
+                logger.warning("Using default font instead.")
+                font_path = None
+                font = ImageFont.load_default()
+
+            with download_cache.in_use(font_path):
+                generate_font_output(config, font)
+
+    instrumentation.log_summary()
+    if config.get('stats_file'):
+        instrumentation.write_summary(config['stats_file'])
 
 
 if __name__ == "__main__":
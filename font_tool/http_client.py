@@ -0,0 +1,86 @@
+import os
+import threading
+
+from instrumentation import instrumentation
+
+
+# Seconds to wait for a connection and for each read from the server
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_RETRIES = 3
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HttpClient:
+    """Shared pooled requests session with timeouts and bounded retries.
+
+    The session (and requests itself) is created on first use, so runs that
+    never touch the network do not pay for it. Connections are kept alive and
+    reused across calls and threads. Idempotent requests that fail to connect,
+    time out or get a RETRY_STATUSES response are retried up to retries times
+    with exponential backoff (backoff * 2 ** attempt seconds, honouring
+    Retry-After).
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=0.5, pool_size=16):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, timeout=None, retries=None):
+        """Change the timeout (seconds, or a (connect, read) pair) and retry count of later requests"""
+        with self._lock:
+            if timeout is not None:
+                self.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else timeout
+            if retries is not None:
+                self.retries = int(retries)
+            # Retries are part of the session's adapters, so build a new one
+            self._session = None
+
+    @property
+    def session(self):
+        with self._lock:
+            # A forked worker must not share the parent's sockets
+            if self._session is None or self._pid != os.getpid():
+                self._session = self._create_session()
+                self._pid = os.getpid()
+            return self._session
+
+    def _create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, url, headers=None, timeout=None):
+        """GET a URL through the shared session, timed as the fetch stage"""
+        with instrumentation.stage('fetch'):
+            response = self.session.get(url, headers=headers, timeout=timeout or self.timeout)
+        instrumentation.count('http_requests')
+        return response
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+
+# Shared by every module of the tool
+http_client = HttpClient()
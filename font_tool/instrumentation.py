@@ -0,0 +1,107 @@
+import contextlib
+import cProfile
+import json
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('font_tool')
+
+
+class Instrumentation:
+    """Per-stage timers and counters for the generation pipeline.
+
+    Stages used by the generator: fetch, convert, load, rasterize, postprocess,
+    encode, write, pack and mapping. Pool workers send their numbers back with
+    drain(), which the parent folds in with merge().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = {}
+            self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block under a stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            total, count = self.timings.get(name, (0.0, 0))
+            self.timings[name] = (total + seconds, count + calls)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def drain(self):
+        """Return the numbers collected so far and start again from zero"""
+        with self._lock:
+            data = {'timings': self.timings, 'counters': self.counters}
+            self.timings = {}
+            self.counters = {}
+        return data
+
+    def merge(self, data):
+        for name, (seconds, calls) in data['timings'].items():
+            self.add_time(name, seconds, calls)
+        for name, amount in data['counters'].items():
+            self.count(name, amount)
+
+    def summary(self):
+        """Return the timings and counters as a JSON-ready dict"""
+        with self._lock:
+            return {
+                'stages': {name: {'seconds': round(seconds, 5), 'calls': calls}
+                           for name, (seconds, calls) in sorted(self.timings.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def log_summary(self, level=logging.INFO):
+        summary = self.summary()
+        for name, stage in summary['stages'].items():
+            logger.log(level, "%-12s %9.4fs over %d calls", name, stage['seconds'], stage['calls'])
+        for name, amount in summary['counters'].items():
+            logger.log(level, "%-20s %d", name, amount)
+
+    def write_summary(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+# Shared by every module of the tool
+instrumentation = Instrumentation()
+
+
+def configure_logging(level='INFO'):
+    """Send the tool's log records to the console at the given level name or number"""
+    if isinstance(level, str):
+        level = getattr(logging, level.upper())
+    logging.basicConfig(format="%(message)s")
+    logger.setLevel(level)
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """Run the enclosed block under cProfile and dump the stats to path (no-op without a path)"""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logger.info("Wrote profile to %s", path)
@@ -1,17 +1,19 @@
-import gradio as gr
-from PIL import Image, ImageDraw, ImageFont
 import os
-import json
 import subprocess
 import platform
-import requests
 import re
-import pyperclip
+import shutil
+import tempfile
+import time
 # Assuming these are in a local file as per your original code
-from font_generator import download_google_font, create_character_image, char_name_map, generate_character_mapping
+from font_generator import covered_characters, download_google_font, fetch_font_css, font_coverage, generate_character_mapping, get_font, iter_render_characters, resolve_workers
+from download_cache import download_cache
+from instrumentation import configure_logging
 
 def open_folder(path):
     """Open the output folder based on the operating system"""
+    if not path:
+        return "Generate some images first"
     if platform.system() == "Windows":
         os.startfile(path)
     elif platform.system() == "Darwin":  # macOS
@@ -20,13 +22,39 @@ def open_folder(path):
         subprocess.run(["xdg-open", path])
     return "Opened folder: " + path
 
-def read_mapping_file():
-    """Read and return the contents of the character mapping file"""
-    try:
-        with open('../character_mapping.txt', 'r') as f:
-            return f.read()
-    except:
-        return "Character mapping will appear here after generation"
+MAPPING_PLACEHOLDER = "Character mapping will appear here after generation"
+
+# Every generation gets its own folder under JOBS_DIR, so concurrent users never share files
+JOBS_DIR = os.environ.get('VERSE_FONT_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'verse_font_jobs'))
+# Seconds a finished job's files are kept for download
+JOB_TTL = int(os.environ.get('VERSE_FONT_JOB_TTL', 3600))
+# Jobs rendered at the same time, and jobs allowed to wait in the queue
+CONCURRENCY = int(os.environ.get('VERSE_FONT_CONCURRENCY', 2))
+QUEUE_SIZE = int(os.environ.get('VERSE_FONT_QUEUE_SIZE', 16))
+# Render processes a single generation may use, whatever the user asks for
+MAX_WORKERS = int(os.environ.get('VERSE_FONT_MAX_WORKERS', 1))
+
+def create_job_dir():
+    """Create a fresh job folder, removing jobs older than JOB_TTL"""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    now = time.time()
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > JOB_TTL:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.unlink(path)
+        except OSError:
+            # Another job cleaned it up first
+            pass
+    return tempfile.mkdtemp(prefix='job_', dir=JOBS_DIR)
+
+def job_folder_name(output_folder):
+    """Return the folder name to use inside a job folder (it is also the Verse module name in the mapping)"""
+    name = os.path.basename(os.path.normpath(output_folder or ""))
+    return name if name not in ("", ".", "..") else "output"
 
 def validate_font_name(input_text):
     """
@@ -44,14 +72,16 @@ def validate_font_name(input_text):
     else:
         font_name = input_text
 
-    # Check if font exists on Google Fonts
-    api_url = f"https://fonts.googleapis.com/css2?family={font_name.replace(' ', '+')}"
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept': 'text/css,*/*;q=0.1',
-    }
-    
-    response = requests.get(api_url, headers=headers)
+    # Fonts already in the download cache are known to exist
+    if download_cache.lookup(font_name, 400, 'latin'):
+        return True, font_name, f"✓ Font '{font_name}' is valid (cached)"
+
+    # Check if font exists on Google Fonts. The response is kept for a few
+    # minutes, so downloading the font right after does not ask again
+    try:
+        response = fetch_font_css(font_name)
+    except Exception as e:
+        return False, "", f"✗ Could not reach Google Fonts: {e}"
     
     if response.status_code == 200:
         return True, font_name, f"✓ Font '{font_name}' is valid"
@@ -67,10 +97,21 @@ def check_font(input_text):
 
 # MODIFIED: A corrected version of the function to fix the error
 
-def generate_font_images(font_name, local_font, font_size, image_size, output_folder, characters):
+# Minimum seconds between gallery refreshes while glyphs are streaming in
+PREVIEW_INTERVAL = 0.25
+
+def generate_font_images(font_name, local_font, font_size, image_size, output_folder, characters, workers=1):
+    """Generate the glyph images, yielding (gallery, status, mapping, zip file, job folder) updates as glyphs finish.
+
+    Each call renders into its own job folder, so concurrent users do not
+    overwrite each other, and ends with a zip of the images and the mapping.
+    Gradio streams every yield to the UI, and cancelling the event closes this
+    generator, which stops the render pool and keeps the finished glyphs.
+    """
+    import gradio as gr
+
     font_path = None
     validated_font_name = "local_font"
-    is_temp_font = False # Flag to check if we need to delete the font file later
 
     # Logic to prioritize local font file over Google Font name
     if local_font is not None:
@@ -79,149 +120,159 @@ def generate_font_images(font_name, local_font, font_size, image_size, output_fo
     elif font_name:
         is_valid, validated_font_name, message = validate_font_name(font_name)
         if not is_valid:
-            return [], message, "Font validation failed"
-        font_path = download_google_font(validated_font_name)
-        is_temp_font = True
+            yield [], message, "Font validation failed", None, gr.update()
+            return
+        yield [], f"Downloading '{validated_font_name}'...", gr.update(), None, gr.update()
     else:
-        return [], "Please provide a font by name or by uploading a file.", "No font specified"
+        yield [], "Please provide a font by name or by uploading a file.", "No font specified", None, gr.update()
+        return
 
     try:
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
+        if font_path is None:
+            font_path = download_google_font(validated_font_name)
 
-        # Convert sizes to integers, just in case
-        font_size_int = int(font_size)
-        image_size_int = int(image_size)
+        # Keep a downloaded font in the cache until this job is done with it
+        with download_cache.in_use(font_path):
+            job_dir = create_job_dir()
+            # The folder name is kept, since the mapping refers to the images through it
+            job_output_folder = os.path.join(job_dir, job_folder_name(output_folder))
+            os.makedirs(job_output_folder)
 
-        font = ImageFont.truetype(font_path, font_size_int)
+            # Convert sizes to integers, just in case
+            font_size_int = int(font_size)
+            image_size_int = int(image_size)
 
-        generated_images = []
-        for char in characters:
-            if char.isalpha():
-                # FIX: Pass 'image_size_int' directly, not a tuple
-                create_character_image(char.lower(), font, image_size_int, output_folder, 'L_')
-                create_character_image(char.upper(), font, image_size_int, output_folder, 'U_')
+            font = get_font(font_path, font_size_int)
+            # Leave out characters the font has no glyphs for instead of rendering tofu
+            characters = covered_characters(characters, font)
 
-                # Load and append the generated images for preview
-                lower_char_name = char_name_map.get(char.lower(), char.lower())
-                upper_char_name = char_name_map.get(char.upper(), char.upper())
+            # Fill the gallery in as glyphs finish, without flooding the browser with updates
+            generated_images = []
+            last_update = 0
+            # Each generation gets at most MAX_WORKERS processes, so a shared server stays bounded
+            workers = min(resolve_workers(workers), MAX_WORKERS)
+            for path, done, total in iter_render_characters(characters, font, image_size_int, job_output_folder, workers):
+                generated_images.append(path)
+                if done == total or time.monotonic() - last_update >= PREVIEW_INTERVAL:
+                    last_update = time.monotonic()
+                    yield list(generated_images), f"Rendering '{validated_font_name}': {done}/{total} glyphs", gr.update(), None, job_dir
 
-                lower_path = os.path.join(output_folder, f"custom_font_L_{lower_char_name}.png")
+            mapping_content = generate_character_mapping(
+                characters, job_folder_name(output_folder), os.path.join(job_dir, 'character_mapping.txt'),
+                coverage=font_coverage(font)
+            )
+            zip_path = shutil.make_archive(job_dir, 'zip', job_dir)
 
-                upper_path = os.path.join(output_folder, f"custom_font_U_{upper_char_name}.png")
-            
-                paths_to_add = set()
-                if os.path.exists(lower_path): paths_to_add.add(lower_path)
-                if os.path.exists(upper_path): paths_to_add.add(upper_path)
-            else:
-                # FIX: Pass 'image_size_int' directly, not a tuple
-                create_character_image(char, font, image_size_int, output_folder, 'S_')
-                
-                # Load and append the generated images for preview
-                symbol_char_name = char_name_map.get(char, char)
-
-                symbol_path = os.path.join(output_folder, f"custom_font_S_{symbol_char_name}.png")
-            
-                paths_to_add = set()
-                if os.path.exists(symbol_path): paths_to_add.add(symbol_path)
-            for path in paths_to_add:
-                generated_images.append(Image.open(path))
-
-        if is_temp_font and font_path:
-            try:
-                os.unlink(font_path)
-            except OSError as e:
-                print(f"Note: Could not delete temp font file: {e}")
-
-        generate_character_mapping(characters, output_folder)
-        mapping_content = read_mapping_file()
-        
-        return generated_images, f"Success! Generated images for '{validated_font_name}'.", mapping_content
+            yield generated_images, f"Success! Generated images for '{validated_font_name}'.", mapping_content, zip_path, job_dir
     except Exception as e:
-        return None, f"Error: {str(e)}", "Error generating character mapping"
+        yield None, f"Error: {str(e)}", "Error generating character mapping", None, gr.update()
 
 def copy_to_clipboard(text):
     """Copy text to clipboard and return status"""
+    import pyperclip
     pyperclip.copy(text)
     return "✓ Mapping copied to clipboard!"
 
-# Create the Gradio interface
-with gr.Blocks(title="Font to Images Generator") as iface:
-    gr.Markdown("""
-    # Font to Images Generator
-    Enter a Google Font name OR upload a local font file.
-    """)
+def create_ui(concurrency=CONCURRENCY, queue_size=QUEUE_SIZE):
+    """Build the Gradio interface (gradio is only imported here, so importing this module stays fast).
+
+    At most concurrency generations run at once; up to queue_size more wait
+    in the queue and further requests are turned away until there is room.
+    """
+    import gradio as gr
+
+    with gr.Blocks(title="Font to Images Generator") as iface:
+        gr.Markdown("""
+        # Font to Images Generator
+        Enter a Google Font name OR upload a local font file.
+        """)
     
-    with gr.Row():
-        # Left Column - Input Controls
-        with gr.Column():
-            with gr.Group():
-                gr.Markdown("### 1. Choose Font")
-                font_name = gr.Textbox(
-                    label="Google Font Name or URL", 
-                    value="Roboto",
-                    placeholder="e.g., 'Roboto' or a Google Fonts URL"
-                )
-                with gr.Row():
-                    check_btn = gr.Button("Check Font", size="sm", variant="secondary")
-                    font_status = gr.Textbox(
-                        label="Status", interactive=False, show_label=False, container=False
+        with gr.Row():
+            # Left Column - Input Controls
+            with gr.Column():
+                with gr.Group():
+                    gr.Markdown("### 1. Choose Font")
+                    font_name = gr.Textbox(
+                        label="Google Font Name or URL", 
+                        value="Roboto",
+                        placeholder="e.g., 'Roboto' or a Google Fonts URL"
                     )
+                    with gr.Row():
+                        check_btn = gr.Button("Check Font", size="sm", variant="secondary")
+                        font_status = gr.Textbox(
+                            label="Status", interactive=False, show_label=False, container=False
+                        )
                 
-                gr.Markdown("<p style='text-align: center; margin: 5px;'>OR</p>")
+                    gr.Markdown("<p style='text-align: center; margin: 5px;'>OR</p>")
                 
-                # NEW: File uploader for local fonts
-                local_font_upload = gr.File(
-                    label="Upload Local Font (.ttf, .otf)",
-                    file_types=[".ttf", ".otf"]
-                )
-
-            with gr.Group():
-                gr.Markdown("### 2. Settings")
-                with gr.Row():
-                    font_size = gr.Number(label="Font Size", value=64, container=True)
-                    image_size = gr.Number(label="Image Size", value=128, container=True)
-                output_folder = gr.Textbox(label="Output Folder", value="output")
-                characters = gr.Textbox(
-                    label="Characters", 
-                    value="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*()_+-=[]{}|;:,.<>?/\\ ",
-                    lines=3
-                )
+                    # NEW: File uploader for local fonts
+                    local_font_upload = gr.File(
+                        label="Upload Local Font (.ttf, .otf)",
+                        file_types=[".ttf", ".otf"]
+                    )
+
+                with gr.Group():
+                    gr.Markdown("### 2. Settings")
+                    with gr.Row():
+                        font_size = gr.Number(label="Font Size", value=64, container=True)
+                        image_size = gr.Number(label="Image Size", value=128, container=True)
+                    output_folder = gr.Textbox(label="Output Folder Name", value="output")
+                    workers = gr.Number(
+                        label=f"Workers (0 = one per CPU core, at most {MAX_WORKERS})", value=1, precision=0,
+                        minimum=0, maximum=MAX_WORKERS, container=True
+                    )
+                    characters = gr.Textbox(
+                        label="Characters", 
+                        value="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*()_+-=[]{}|;:,.<>?/\\ ",
+                        lines=3
+                    )
             
-            with gr.Row():
-                generate_btn = gr.Button("3. Generate Images", variant="primary")
-                open_folder_btn = gr.Button("Open Output Folder", variant="secondary")
+                with gr.Row():
+                    generate_btn = gr.Button("3. Generate Images", variant="primary")
+                    stop_btn = gr.Button("Stop", variant="stop")
+                    open_folder_btn = gr.Button("Open Output Folder", variant="secondary")
         
-        # Right Column - Output Display
-        with gr.Column():
-            with gr.Group():
-                gr.Markdown("### Preview")
-                gallery = gr.Gallery(label="Generated Images", show_label=False, columns=8, height="auto")
-                status = gr.Textbox(label="Status", show_label=False, interactive=False)
+            # Right Column - Output Display
+            with gr.Column():
+                with gr.Group():
+                    gr.Markdown("### Preview")
+                    gallery = gr.Gallery(label="Generated Images", show_label=False, columns=8, height="auto")
+                    status = gr.Textbox(label="Status", show_label=False, interactive=False)
+                    download = gr.File(label="Download Images and Mapping (.zip)", interactive=False)
             
-            with gr.Group():
-                gr.Markdown("### Character Mapping")
-                with gr.Row():
-                    mapping = gr.Textbox(
-                        label="Generated Mapping", value=read_mapping_file(), lines=10, max_lines=10, show_label=False
+                with gr.Group():
+                    gr.Markdown("### Character Mapping")
+                    with gr.Row():
+                        mapping = gr.Textbox(
+                            label="Generated Mapping", value=MAPPING_PLACEHOLDER, lines=10, max_lines=10, show_label=False
+                        )
+                        copy_btn = gr.Button("📋 Copy", size="sm")
+                    copy_status = gr.Textbox(
+                        label="Copy Status", show_label=False, container=False, interactive=False
                     )
-                    copy_btn = gr.Button("📋 Copy", size="sm")
-                copy_status = gr.Textbox(
-                    label="Copy Status", show_label=False, container=False, interactive=False
-                )
     
-    # Event handlers
-    check_btn.click(fn=check_font, inputs=[font_name], outputs=[font_status, font_name])
+        # The current session's job folder, for the open folder button
+        job_dir = gr.State(None)
+
+        # Event handlers
+        check_btn.click(fn=check_font, inputs=[font_name], outputs=[font_status, font_name])
     
-    # MODIFIED: Add 'local_font_upload' to the inputs list
-    generate_btn.click(
-        fn=generate_font_images,
-        inputs=[font_name, local_font_upload, font_size, image_size, output_folder, characters],
-        outputs=[gallery, status, mapping]
-    )
+        # MODIFIED: Add 'local_font_upload' to the inputs list
+        generate_event = generate_btn.click(
+            fn=generate_font_images,
+            inputs=[font_name, local_font_upload, font_size, image_size, output_folder, characters, workers],
+            outputs=[gallery, status, mapping, download, job_dir],
+            concurrency_limit=concurrency
+        )
     
-    open_folder_btn.click(fn=open_folder, inputs=[output_folder], outputs=[status])
-    copy_btn.click(fn=copy_to_clipboard, inputs=[mapping], outputs=[copy_status])
+        stop_btn.click(fn=None, cancels=[generate_event])
+        open_folder_btn.click(fn=open_folder, inputs=[job_dir], outputs=[status])
+        copy_btn.click(fn=copy_to_clipboard, inputs=[mapping], outputs=[copy_status])
+
+    iface.queue(max_size=queue_size, default_concurrency_limit=concurrency)
+    return iface
+
 
 if __name__ == "__main__":
-    iface.launch()
\ No newline at end of file
+    configure_logging(os.environ.get('VERSE_FONT_LOG_LEVEL', 'INFO'))
+    create_ui().launch(allowed_paths=[JOBS_DIR])
\ No newline at end of file
@@ -0,0 +1,126 @@
+from fontTools.pens.boundsPen import BoundsPen
+from fontTools.ttLib import TTFont
+
+
+def _pair_pos_subtables(gpos):
+    """Yield every PairPos subtable of the GPOS lookups used by the kern feature"""
+    lookup_indices = set()
+    if gpos.FeatureList:
+        for record in gpos.FeatureList.FeatureRecord:
+            if record.FeatureTag == 'kern':
+                lookup_indices.update(record.Feature.LookupListIndex)
+    for index in sorted(lookup_indices):
+        lookup = gpos.LookupList.Lookup[index]
+        for subtable in lookup.SubTable:
+            # Extension lookups (type 9) wrap the real subtable
+            if lookup.LookupType == 9:
+                subtable = subtable.ExtSubTable
+            if subtable.LookupType == 2:
+                yield index, subtable
+
+
+def _x_advance(value):
+    return getattr(value, 'XAdvance', 0) if value is not None else 0
+
+
+def read_kerning(ttfont, glyph_names):
+    """Return {(left glyph, right glyph): x adjustment in font units} between the given glyphs.
+
+    Reads PairPos lookups of the GPOS kern feature (formats 1 and 2) and falls
+    back to a legacy kern table. Within a lookup the first matching subtable
+    wins, and adjustments from separate lookups add up.
+    """
+    wanted = set(glyph_names)
+    pairs = {}
+
+    if 'GPOS' in ttfont:
+        lookup_pairs = {}
+        for index, subtable in _pair_pos_subtables(ttfont['GPOS'].table):
+            found = lookup_pairs.setdefault(index, {})
+            coverage = [glyph for glyph in subtable.Coverage.glyphs if glyph in wanted]
+            if subtable.Format == 1:
+                pair_sets = dict(zip(subtable.Coverage.glyphs, subtable.PairSet))
+                for left in coverage:
+                    for record in pair_sets[left].PairValueRecord:
+                        if record.SecondGlyph in wanted:
+                            found.setdefault((left, record.SecondGlyph), _x_advance(record.Value1))
+            elif subtable.Format == 2:
+                class1 = subtable.ClassDef1.classDefs
+                class2 = subtable.ClassDef2.classDefs
+                right_classes = {glyph: class2.get(glyph, 0) for glyph in wanted}
+                for left in coverage:
+                    row = subtable.Class1Record[class1.get(left, 0)].Class2Record
+                    for right, right_class in right_classes.items():
+                        value = _x_advance(row[right_class].Value1)
+                        if value:
+                            found.setdefault((left, right), value)
+        for found in lookup_pairs.values():
+            for pair, value in found.items():
+                pairs[pair] = pairs.get(pair, 0) + value
+
+    if not pairs and 'kern' in ttfont:
+        for table in ttfont['kern'].kernTables:
+            for (left, right), value in getattr(table, 'kernTable', {}).items():
+                if left in wanted and right in wanted:
+                    pairs.setdefault((left, right), value)
+
+    return {pair: value for pair, value in pairs.items() if value}
+
+
+def read_font_metrics(font_path, characters, variation=None):
+    """Read advance, left side bearing, ink bbox and kerning for characters in one pass.
+
+    All values are in font units. Returns a dict with units_per_em, ascender,
+    descender, glyphs ({char: {...}}, characters missing from the font are
+    left out) and kerning ({left char + right char: adjustment}). variation is
+    a variable font instance as axis values in the font's axis order (as given
+    to set_variation_by_axes); advances and bounds are read at that instance,
+    kerning is the default instance's.
+    """
+    ttfont = TTFont(font_path, lazy=True)
+    cmap = ttfont.getBestCmap() or {}
+    hmtx = ttfont['hmtx']
+    location = None
+    if isinstance(variation, (list, tuple)) and 'fvar' in ttfont:
+        location = {axis.axisTag: value for axis, value in zip(ttfont['fvar'].axes, variation)}
+    glyph_set = ttfont.getGlyphSet(location=location)
+
+    glyph_names = {}
+    glyphs = {}
+    for char in dict.fromkeys(characters):
+        glyph_name = cmap.get(ord(char))
+        if glyph_name is None:
+            continue
+        glyph_names[char] = glyph_name
+        advance, lsb = hmtx[glyph_name]
+        pen = BoundsPen(glyph_set)
+        glyph_set[glyph_name].draw(pen)
+        if location:
+            advance = round(glyph_set[glyph_name].width)
+            lsb = round(pen.bounds[0]) if pen.bounds else 0
+        glyphs[char] = {
+            'glyph': glyph_name,
+            'advance': advance,
+            'lsb': lsb,
+            'bbox': list(pen.bounds) if pen.bounds else None,
+        }
+
+    chars_by_glyph = {}
+    for char, glyph_name in glyph_names.items():
+        chars_by_glyph.setdefault(glyph_name, []).append(char)
+    kerning = {}
+    for (left, right), value in read_kerning(ttfont, glyph_names.values()).items():
+        for left_char in chars_by_glyph[left]:
+            for right_char in chars_by_glyph[right]:
+                kerning[left_char + right_char] = value
+
+    hhea = ttfont['hhea']
+    metrics = {
+        'units_per_em': ttfont['head'].unitsPerEm,
+        'ascender': hhea.ascent,
+        'descender': hhea.descent,
+        'glyphs': glyphs,
+        'kerning': kerning,
+    }
+    ttfont.close()
+    return metrics
@@ -0,0 +1,173 @@
+import numpy as np
+from PIL import Image, ImageColor
+
+
+# Glyphs are post-processed this many at a time as one stacked array
+EFFECT_BATCH_SIZE = 64
+
+
+def _color(value):
+    """Parse a color name / hex string / RGB list into a float32 RGB array in 0..1"""
+    if isinstance(value, str):
+        value = ImageColor.getrgb(value)
+    return np.asarray(value[:3], dtype=np.float32) / 255.0
+
+
+def _shift(alpha, dx, dy, fill=0):
+    """Shift a (N, H, W) stack by whole pixels, filling the uncovered edge with fill"""
+    if dx == 0 and dy == 0:
+        return alpha
+    height, width = alpha.shape[1:]
+    pad_x, pad_y = abs(dx), abs(dy)
+    padded = np.pad(alpha, ((0, 0), (pad_y, pad_y), (pad_x, pad_x)), constant_values=fill)
+    return padded[:, pad_y - dy:pad_y - dy + height, pad_x - dx:pad_x - dx + width]
+
+
+def dilate(alpha, radius):
+    """Grow the coverage of a (N, H, W) alpha stack by a disc of the given radius"""
+    result = alpha.copy()
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if (dx or dy) and dx * dx + dy * dy <= radius * radius + radius:
+                np.maximum(result, _shift(alpha, dx, dy), out=result)
+    return result
+
+
+def _box_blur(alpha, radius, axis):
+    # Running sum along one axis, so the cost does not depend on the radius
+    padded = np.pad(alpha, [(radius + 1, radius) if i == axis else (0, 0) for i in range(alpha.ndim)], mode='edge')
+    summed = np.cumsum(padded, axis=axis, dtype=np.float32)
+    upper = np.take(summed, np.arange(2 * radius + 1, summed.shape[axis]), axis=axis)
+    lower = np.take(summed, np.arange(0, summed.shape[axis] - 2 * radius - 1), axis=axis)
+    return (upper - lower) / (2 * radius + 1)
+
+
+def blur(alpha, radius):
+    """Approximate a gaussian blur of a (N, H, W) stack with three separable box blurs"""
+    for _ in range(3):
+        alpha = _box_blur(_box_blur(alpha, radius, 1), radius, 2)
+    return alpha
+
+
+def _squared_distance(mask, radius):
+    """Squared distance from every pixel of a (N, H, W) bool stack to the nearest True pixel.
+
+    Exact up to radius; anything farther comes out as (radius + 1) ** 2. Runs
+    as two separable passes of shifted minimums, so the cost grows with the
+    radius rather than the image size.
+    """
+    height, width = mask.shape[1:]
+    far = np.float32((radius + 1) ** 2)
+    # Horizontal distance to the nearest pixel in the same row
+    padded = np.pad(mask, ((0, 0), (0, 0), (radius, radius)))
+    rows = np.full(mask.shape, far, dtype=np.float32)
+    for dx in range(-radius, radius + 1):
+        np.minimum(rows, np.float32(dx * dx), out=rows, where=padded[:, :, radius + dx:radius + dx + width])
+    # The nearest pixel overall is the best row distance plus the vertical offset
+    padded = np.pad(rows, ((0, 0), (radius, radius), (0, 0)), constant_values=far)
+    result = rows.copy()
+    shifted = np.empty_like(rows)
+    for dy in range(-radius, radius + 1):
+        if dy:
+            np.add(padded[:, radius + dy:radius + dy + height], np.float32(dy * dy), out=shifted)
+            np.minimum(result, shifted, out=result)
+    return np.minimum(result, far)
+
+
+def signed_distance_field(alpha, spread, scale=1):
+    """Turn a (N, H, W) coverage stack into a signed distance field in 0..1.
+
+    The glyph edge maps to 0.5, insides are above and outsides below, reaching
+    1 and 0 at spread pixels from the edge. alpha is expected to be rendered
+    scale times larger than the output, which the field is reduced to by
+    averaging scale x scale blocks, so the edge is placed with sub-pixel
+    precision.
+    """
+    radius = int(np.ceil(spread * scale))
+    # Pad so pixels near the border also see the outside beyond it
+    inside = np.pad(alpha >= 0.5, ((0, 0), (radius, radius), (radius, radius)))
+    to_inside = np.sqrt(_squared_distance(inside, radius))
+    to_outside = np.sqrt(_squared_distance(~inside, radius))
+    # Distances are between pixel centres, so the edge sits half a pixel away
+    signed = np.where(inside, to_outside - 0.5, 0.5 - to_inside)[:, radius:-radius, radius:-radius]
+
+    count, height, width = signed.shape
+    signed = signed.reshape(count, height // scale, scale, width // scale, scale).mean(axis=(2, 4))
+    return np.clip(0.5 + signed / (2.0 * spread * scale), 0.0, 1.0)
+
+
+def distance_field_images(images, spread=4, scale=4):
+    """Convert glyph images rendered at scale times the output size into white RGBA SDF images.
+
+    The field is stored in the alpha channel, so the glyphs still show up
+    (softened) without a distance field material.
+    """
+    if not images:
+        return []
+    alpha = np.stack([np.asarray(image.getchannel('A')) for image in images]).astype(np.float32) / 255.0
+    field = np.clip(np.rint(signed_distance_field(alpha, spread, scale) * 255.0), 0, 255).astype(np.uint8)
+    white = np.full(field.shape + (3,), 255, dtype=np.uint8)
+    pixels = np.concatenate([white, field[..., None]], axis=-1)
+    return [Image.fromarray(pixels[i], 'RGBA') for i in range(len(pixels))]
+
+
+def _over(top_rgb, top_alpha, bottom_rgb, bottom_alpha):
+    """Composite one straight-alpha layer over another"""
+    alpha = top_alpha + bottom_alpha * (1.0 - top_alpha)
+    weight_top = top_alpha[..., None]
+    weight_bottom = (bottom_alpha * (1.0 - top_alpha))[..., None]
+    rgb = (top_rgb * weight_top + bottom_rgb * weight_bottom) / np.maximum(alpha[..., None], 1e-6)
+    return rgb, alpha
+
+
+def apply_effects(images, effects):
+    """Bake outline, drop shadow, tint, padding and premultiplication into glyph images.
+
+    All images must have the same size; they are processed together as one
+    (N, H, W, 4) array. effects is a dict with any of:
+      pad: pixels of transparent margin added on every side (so effects are not clipped)
+      tint: fill color for the glyph itself
+      outline: {"width": px, "color": ...}
+      shadow: {"offset": [x, y], "blur": px, "color": ..., "opacity": 0..1}
+      premultiply: store color premultiplied by alpha
+    Returns a list of RGBA images in the same order.
+    """
+    if not images:
+        return []
+    pixels = np.stack([np.asarray(image.convert('RGBA')) for image in images]).astype(np.float32) / 255.0
+
+    pad = int(effects.get('pad', 0))
+    if pad:
+        pixels = np.pad(pixels, ((0, 0), (pad, pad), (pad, pad), (0, 0)))
+
+    fill_alpha = pixels[..., 3]
+    fill_rgb = pixels[..., :3]
+    if effects.get('tint'):
+        fill_rgb = np.broadcast_to(_color(effects['tint']), fill_rgb.shape)
+    rgb, alpha = fill_rgb, fill_alpha
+
+    # Everything below the fill is shaped like the fill plus its outline
+    shape_alpha = fill_alpha
+    outline = effects.get('outline')
+    if outline and outline.get('width', 0) > 0:
+        shape_alpha = dilate(fill_alpha, int(outline['width']))
+        outline_rgb = np.broadcast_to(_color(outline.get('color', 'black')), rgb.shape)
+        rgb, alpha = _over(rgb, alpha, outline_rgb, shape_alpha)
+
+    shadow = effects.get('shadow')
+    if shadow:
+        offset_x, offset_y = shadow.get('offset', (2, 2))
+        shadow_alpha = _shift(shape_alpha, int(offset_x), int(offset_y))
+        if shadow.get('blur', 0) > 0:
+            shadow_alpha = blur(shadow_alpha, int(shadow['blur']))
+        shadow_alpha = shadow_alpha * float(shadow.get('opacity', 1.0))
+        shadow_rgb = np.broadcast_to(_color(shadow.get('color', 'black')), rgb.shape)
+        rgb, alpha = _over(rgb, alpha, shadow_rgb, shadow_alpha)
+
+    if effects.get('premultiply'):
+        rgb = rgb * alpha[..., None]
+
+    pixels = np.concatenate([rgb, alpha[..., None]], axis=-1)
+
+    pixels = np.clip(np.rint(pixels * 255.0), 0, 255).astype(np.uint8)
+    return [Image.fromarray(pixels[i], 'RGBA') for i in range(len(pixels))]